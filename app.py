@@ -1,53 +1,382 @@
-from flask import Flask, request, jsonify, abort
+import json
+import os
+import time
+import zlib
+from flask import Flask, Response, g, request, jsonify, abort, stream_with_context
 from flask_cors import CORS
-from maze import Maze, MazeCell
+import numpy as np
+from maze import Maze, encode_array
+from registry import MazeRegistry, OverBudget, Pinned
+from jobs import JobManager
+from snapshot import Checkpointer
+from metrics import registry, BYTES_BUCKETS, CONTENT_TYPE
 
 app = Flask(__name__)
 
 CORS(app, resources={r"/*": {"origins": "*", "allow_headers": "Content-Type"}})
 
+# total memory for mazes in bytes, least recently used mazes are evicted beyond it,
+# larger mazes are refused with 413
+app.config['MAZE_MEMORY_BUDGET'] = int(os.environ.get('MAZE_MEMORY_BUDGET', 1 << 30))
+# number of training jobs run at once
+app.config['TRAINING_WORKERS'] = int(os.environ.get('TRAINING_WORKERS', 2))
+# where maze snapshots are kept, and seconds between checkpoints of changed mazes, 0 for none
+app.config['SNAPSHOT_DIR'] = os.environ.get('SNAPSHOT_DIR', 'snapshots')
+app.config['CHECKPOINT_INTERVAL'] = float(os.environ.get('CHECKPOINT_INTERVAL', 300))
+# total bytes of snapshots, the oldest snapshots of mazes not in memory are deleted beyond it
+app.config['SNAPSHOT_DISK_BUDGET'] = int(os.environ.get('SNAPSHOT_DISK_BUDGET', 10 << 30))
+
 # persistent data
-maze = None # maze object when created
+mazes = MazeRegistry(app.config['MAZE_MEMORY_BUDGET']) # mazes by id
+jobs = JobManager(mazes, app.config['TRAINING_WORKERS']) # training jobs by id
+checkpoints = Checkpointer(mazes, app.config['SNAPSHOT_DIR'], app.config['CHECKPOINT_INTERVAL'],
+                           app.config['SNAPSHOT_DISK_BUDGET'])
+
+# request and maze metrics, training metrics are recorded by the jobs
+request_seconds = registry.histogram('http_request_duration_seconds', 'Time to handle a request, by endpoint.',
+                                     ('method', 'endpoint'))
+requests_total = registry.counter('http_requests_total', 'Requests handled, by endpoint and status.',
+                                  ('method', 'endpoint', 'status'))
+serialization_seconds = registry.histogram('maze_serialization_seconds', 'Time to build a maze response, by format.',
+                                           ('format',))
+payload_bytes = registry.histogram('maze_payload_bytes', 'Size of maze responses, by format.',
+                                   ('format',), BYTES_BUCKETS)
+registry.gauge('maze_memory_bytes', 'Approximate memory used by the mazes held.', function=lambda: mazes.total_size)
+registry.gauge('maze_memory_budget_bytes', 'Memory budget for mazes.', function=lambda: mazes.memory_budget)
+registry.gauge('mazes', 'Mazes held.', function=lambda: len(mazes.entries))
+
+@app.before_request
+def start_checkpoints():
+    "checkpoints start with the first request, not on import, so worker processes don't run them"
+    checkpoints.start()
+
+@app.before_request
+def start_request_timer():
+    "note the start time of the request for the latency metrics"
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    "record the time taken by the request, by its route rather than its url so maze ids don't add labels"
+    if 'request_start' in g:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_seconds.observe(time.perf_counter() - g.request_start, method=request.method, endpoint=endpoint)
+        requests_total.inc(method=request.method, endpoint=endpoint, status=response.status_code)
+    return response
+
+@app.after_request
+def resize_entry(response):
+    "record the size of the maze used by the request, it grows as distances, policies and solutions are cached"
+    if 'entry' in g:
+        mazes.resize(g.entry)
+    return response
+
+@app.errorhandler(OverBudget)
+def over_budget(e):
+    "a maze, new or restored, larger than the memory budget"
+    return str(e), 413
+
+@app.errorhandler(Pinned)
+def pinned(e):
+    "restoring a maze while a job trains it"
+    return str(e), 409
+
+def get_entry(maze_id):
+    """
+    Return the registry entry for a maze id.
+    A maze that isn't in memory, after a restart or eviction, is restored from its snapshot.
+    404 if there is neither.
+    """
+    entry = checkpoints.get(maze_id)
+    if not entry:
+        abort(404)
+    g.entry = entry
+    return entry
+
+def get_job(job_id):
+    "return a training job by id, 404 if it is unknown"
+    job = jobs.get(job_id)
+    if not job:
+        abort(404)
+    return job
+
+def whole_number(value, minimum = 0, maximum = None):
+    "True for an int from minimum to maximum"
+    return type(value) is int and value >= minimum and (maximum is None or value <= maximum)
+
+def non_negative(value):
+    "True for an int or float of at least 0"
+    return type(value) in (int, float) and value >= 0
+
+def in_maze(maze, x, y):
+    "True for integer x, y locations inside the maze"
+    return type(x) is int and type(y) is int and 0 <= x < maze.cols and 0 <= y < maze.rows
+
+# q value types for the compact formats
+Q_DTYPES = ('float16', 'float32', 'float64')
+
+def maze_json(entry):
+    """
+    The maze as json with its id.
+    Query arguments select a compact format, see Maze.dict_for_compact_json:
+    format=compact, q_dtype to send q values as float16, float32 or float64, and
+    since=<version> to send only the q values changed after that version.
+    Versions start again when a maze is restored, so clients send the epoch of the version
+    with since, the full maze is sent if the epoch differs or since is ahead of the version.
+    The compact formats carry an ETag for the maze epoch and version, 304 if the client has it.
+    The hyperparameters and total passes can change without the version, so they are in the ETag too.
+    """
+    maze = entry.maze
+    start = time.perf_counter()
+    if request.args.get('format', 'json') == 'json':
+        result = maze.dict_for_json()
+        result['id'] = entry.id
+        return serialized(jsonify(result), 'json', start)
+    if request.args['format'] != 'compact':
+        abort(400)
+    q_dtype = request.args.get('q_dtype', 'float64')
+    since = request.args.get('since', type=int)
+    if q_dtype not in Q_DTYPES:
+        abort(400)
+    if since is not None and (since > maze.version or request.args.get('epoch', maze.epoch) != maze.epoch):
+        since = None # from another epoch, the client needs the whole maze
+    hp = zlib.crc32(json.dumps(maze.hp.__dict__, sort_keys=True).encode())
+    etag = f'{entry.id}-{maze.epoch}-{maze.version}-{maze.total_training_passes}-{hp:08x}-{q_dtype}-{since}'
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        if since is None:
+            result = maze.dict_for_compact_json(q_dtype)
+        else:
+            result = maze.dict_for_delta_json(since, q_dtype)
+        result['id'] = entry.id
+        response = serialized(jsonify(result), 'compact' if since is None else 'delta', start)
+    response.set_etag(etag)
+    return response
+
+def serialized(response, format, start):
+    "record the time to build a maze response since start and its size"
+    serialization_seconds.observe(time.perf_counter() - start, format=format)
+    payload_bytes.observe(response.content_length or 0, format=format)
+    return response
 
 # Create
+# returns the maze, including the id used to address it, formats as for Get Maze
 @app.route('/create', methods=['POST'])
 def create_maze():
-    global maze
     data = request.get_json()
     if not data:
         abort(400)
+    rows, cols, seed = data.get('rows'), data.get('cols'), data.get('seed')
+    if not whole_number(rows, 1) or not whole_number(cols, 1) or not (seed is None or type(seed) is int):
+        abort(400)
+    if not mazes.fits(Maze.estimated_nbytes(rows, cols)):
+        abort(413) # refused before any memory is allocated
     maze = Maze(data) # rows and cols
-    maze.make_maze(MazeCell(0, 0, maze))
-    return jsonify(maze.dict_for_json()), 201
+    maze.make_maze((0, 0), seed)
+    entry = g.entry = mazes.add(maze)
+    with entry.lock:
+        return maze_json(entry), 201
 
 # Get Maze
-@app.route('/maze', methods=['GET'])
-def get_maze():
-    if not maze:
-        abort(400)
-    return jsonify(maze.dict_for_json())
+# ?format=compact for packed arrays, with since=<version> for only the q values changed since then
+@app.route('/maze/<maze_id>', methods=['GET'])
+def get_maze(maze_id):
+    entry = get_entry(maze_id)
+    with entry.lock:
+        return maze_json(entry)
+
+# Delete Maze
+# also deletes its snapshot
+@app.route('/maze/<maze_id>', methods=['DELETE'])
+def delete_maze(maze_id):
+    removed = mazes.remove(maze_id)
+    if not checkpoints.remove(maze_id) and not removed:
+        abort(404)
+    return '', 204
 
 # Run training
-@app.route('/train', methods=['POST'])
-def run_q_learning():
-    global maze
+# training runs as a background job, returns the job status with its id
+@app.route('/train/<maze_id>', methods=['POST'])
+def run_q_learning(maze_id):
+    entry = get_entry(maze_id)
     data = request.get_json()
     if not data:
         abort(400)
-    maze.rl_train(data['passes']) # number of passes to run
-    return jsonify({'total_training_passes': maze.total_training_passes}), 200 # returns total training passes
+    if entry.maze.read_only:
+        abort(409) # restored read only
+    passes = data.get('passes') # number of passes to run
+    batch_size = data.get('batch_size', 1) # agents trained together
+    workers = data.get('workers', 1) # processes, q tables merged every sync_passes
+    sync_passes = data.get('sync_passes', 100)
+    if not (whole_number(passes) and whole_number(batch_size, 1) and
+            whole_number(workers, 1, os.cpu_count()) and whole_number(sync_passes, 1)):
+        abort(400)
+    if not (whole_number(data.get('planning_steps', 0)) and type(data.get('prioritized_sweeping', False)) is bool and
+            non_negative(data.get('priority_threshold', 0))):
+        abort(400)
+    seed = data.get('seed')
+    until_converged = data.get('until_converged') # fraction of cells, passes is the limit
+    max_episode_steps = data.get('max_episode_steps')
+    if not ((seed is None or type(seed) is int) and
+            (until_converged is None or (non_negative(until_converged) and 0 < until_converged <= 1)) and
+            (max_episode_steps is None or whole_number(max_episode_steps, 1))):
+        abort(400)
+    with entry.lock:
+        # planning is set in the maze hyperparameters and kept for later training
+        for name in ('planning_steps', 'prioritized_sweeping', 'priority_threshold'):
+            if name in data:
+                setattr(entry.maze.hp, name, data[name])
+    job = jobs.submit(entry.id, passes,
+                      batch_size=batch_size,
+                      workers=workers,
+                      sync_passes=sync_passes,
+                      seed=seed,
+                      until_converged=until_converged,
+                      max_episode_steps=max_episode_steps,
+                      profile=data.get('profile', False)) # sample the job's stack, see /jobs/<id>/profile
+    return jsonify(job.status()), 202, {'Location': f'/jobs/{job.id}'}
+
+# Training job status
+# passes done, steps per second and average episode length
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_training_job(job_id):
+    return jsonify(get_job(job_id).status())
+
+# Cancel a training job
+# training stops at the end of the current chunk, passes already run are kept
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_training_job(job_id):
+    job = get_job(job_id)
+    job.cancel()
+    return jsonify(job.status())
+
+# Stream training job status as server sent events
+# an event is sent for every status change until the job finishes
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def training_job_events(job_id):
+    job = get_job(job_id)
+
+    def events():
+        version = None
+        while True:
+            # send the status on change, or every 15 seconds to keep the connection open
+            version = job.wait_for_change(version, 15)
+            yield f'data: {json.dumps(job.status())}\n\n'
+            if job.finished():
+                return
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+# Training job profile
+# hot functions and stacks sampled from a job started with profile, as json,
+# or ?format=collapsed for the collapsed stacks used by flame graph tools
+@app.route('/jobs/<job_id>/profile', methods=['GET'])
+def training_job_profile(job_id):
+    job = get_job(job_id)
+    if not job.profiler:
+        abort(404)
+    if request.args.get('format') == 'collapsed':
+        return Response(job.profiler.collapsed(), mimetype='text/plain')
+    return jsonify(job.profiler.report(request.args.get('limit', 30, type=int)))
+
+# Metrics
+# request, serialization, training and memory metrics in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(registry.expose(), content_type=CONTENT_TYPE)
+
+# Snapshot a maze
+# writes the maze and its q values to disk, restored automatically when the maze is next used
+@app.route('/snapshot/<maze_id>', methods=['POST'])
+def snapshot_maze(maze_id):
+    header = checkpoints.save(get_entry(maze_id))
+    if not header:
+        abort(404) # deleted meanwhile
+    return jsonify({'id': maze_id,
+                    'version': header['version'],
+                    'total_training_passes': header['total_training_passes']}), 201
+
+# List snapshots
+@app.route('/snapshots', methods=['GET'])
+def list_snapshots():
+    return jsonify(checkpoints.snapshots())
+
+# Restore a maze from its snapshot
+# replaces the maze in memory, read_only maps it without allowing training, 409 while a job trains it
+@app.route('/restore/<maze_id>', methods=['POST'])
+def restore_maze(maze_id):
+    data = request.get_json(silent=True) or {}
+    entry = checkpoints.restore(maze_id, data.get('read_only', False))
+    if not entry:
+        abort(404)
+    return jsonify({'id': maze_id,
+                    'epoch': entry.maze.epoch,
+                    'version': entry.maze.version,
+                    'total_training_passes': entry.maze.total_training_passes}), 200
+
+# Convergence of the learned policy
+# fraction of cells whose greedy path reaches the goal, and how close those paths are to the shortest
+@app.route('/convergence/<maze_id>', methods=['GET'])
+def get_convergence(maze_id):
+    entry = get_entry(maze_id)
+    with entry.lock:
+        return jsonify(entry.maze.convergence())
+
+# Policy map
+# the greedy successor and greedy path length to the goal (-1 if never reached) of every cell,
+# as base64 int32 arrays of flat state numbers (y * cols + x), with an ETag for the maze version
+@app.route('/policy/<maze_id>', methods=['GET'])
+def get_policy(maze_id):
+    entry = get_entry(maze_id)
+    with entry.lock:
+        etag = f'{entry.id}-{entry.maze.epoch}-{entry.maze.version}-policy'
+        if etag in request.if_none_match:
+            response = app.response_class(status=304)
+        else:
+            successors, lengths = entry.maze.policy_map()
+            response = jsonify({'id': entry.id,
+                                'epoch': entry.maze.epoch,
+                                'version': entry.maze.version,
+                                'successors': encode_array(successors.astype(np.int32)),
+                                'lengths': encode_array(lengths.astype(np.int32))})
+    response.set_etag(etag)
+    return response
 
 # Solve based on learned policy, max q
 # receives starting x, y, and maximum steps
 # returns the solution path as a list  of x, y pairs
-@app.route('/solve', methods=['POST'])
-def solve():
-    global maze
+@app.route('/solve/<maze_id>', methods=['POST'])
+def solve(maze_id):
+    entry = get_entry(maze_id)
+    data = request.get_json()
+    if not data or not in_maze(entry.maze, data.get('x'), data.get('y')) or not whole_number(data.get('max_steps')):
+        abort(400)
+    with entry.lock:
+        entry.maze.solve_from(data['x'], data['y'], data['max_steps']) #
+        return jsonify({'solve_path': entry.maze.solve_path}), 200 # returns solution path
+
+# Solve from many starting points
+# receives a list of starting [x, y] pairs and maximum steps
+# returns for each start the solution path, whether it reached the goal and the greedy path length
+@app.route('/solve/<maze_id>/batch', methods=['POST'])
+def solve_batch(maze_id):
+    entry = get_entry(maze_id)
     data = request.get_json()
     if not data:
         abort(400)
-    maze.solve_from(data['x'], data['y'], data['max_steps']) # 
-    return jsonify({'solve_path': maze.solve_path}), 200 # returns solution path
+    maze = entry.maze
+    starts = data.get('starts')
+    max_steps = data.get('max_steps', 1000)
+    if (not isinstance(starts, list) or not whole_number(max_steps) or
+        not all(isinstance(start, list) and len(start) == 2 and in_maze(maze, *start) for start in starts)):
+        abort(400)
+    with entry.lock:
+        return jsonify({'epoch': maze.epoch,
+                        'version': maze.version,
+                        'solutions': maze.solve_batch(starts, max_steps)}), 200
+
 
 if __name__ == '__main__':
     app.run(debug=True)
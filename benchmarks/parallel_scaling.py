@@ -0,0 +1,42 @@
+"""
+Measure how parallel training throughput scales with the number of worker processes.
+
+    python benchmarks/parallel_scaling.py [--size 100] [--passes 2000] [--max-workers N]
+
+Every run trains a fresh copy of the same seeded maze with the same training seed.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from maze import Maze
+from parallel import ParallelTrainer
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=100, help='rows and columns of the maze')
+    parser.add_argument('--passes', type=int, default=2000)
+    parser.add_argument('--sync-passes', type=int, default=200)
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print(f'{args.size}x{args.size} maze, {args.passes} passes, sync every {args.sync_passes}')
+    print(f'{"workers":>8} {"seconds":>9} {"steps":>10} {"steps/s":>10} {"speedup":>8}')
+    base_rate = None
+    for workers in range(1, args.max_workers + 1):
+        maze = Maze({'rows': args.size, 'cols': args.size})
+        maze.make_maze(seed=args.seed)
+        with ParallelTrainer(maze, workers, args.sync_passes, args.seed) as trainer:
+            start = time.perf_counter()
+            steps = trainer.train(args.passes)
+            elapsed = time.perf_counter() - start
+        rate = steps / elapsed
+        base_rate = base_rate or rate
+        print(f'{workers:>8} {elapsed:>9.2f} {steps:>10} {rate:>10.0f} {rate / base_rate:>8.2f}')
+
+if __name__ == '__main__':
+    main()
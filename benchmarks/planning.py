@@ -0,0 +1,60 @@
+"""
+Measure the time and steps training takes to converge with and without planning.
+
+    python benchmarks/planning.py [--size 40] [--target 0.95] [--seeds 1 2 3]
+
+Every run trains a fresh copy of the same seeded maze in chunks of --chunk steps until
+the greedy policy reaches the goal from --target of the cells, see Maze.convergence.
+Only the training is timed, not the convergence checks between chunks.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from maze import Maze
+
+# (planning_steps, prioritized_sweeping) of each mode
+MODES = {'none': (0, False), 'dyna 20': (20, False), 'sweeping 20': (20, True), 'sweeping 50': (50, True)}
+
+def converge(size, planning_steps, sweeping, seed, target, chunk, limit):
+    "train until converged or limit seconds, return (seconds, steps, converged)"
+    maze = Maze({'rows': size, 'cols': size})
+    maze.make_maze(seed=1)
+    maze.hp.planning_steps = planning_steps
+    maze.hp.prioritized_sweeping = sweeping
+    max_episode_steps = 4 * int(maze.goal_distances().max()) + 100
+    elapsed = 0.0
+    steps = 0
+    converged = 0.0
+    while converged < target and elapsed < limit:
+        start = time.perf_counter()
+        steps += maze.rl_train(1 << 30, 1, seed, max_episode_steps, chunk, maze.unfinished)
+        elapsed += time.perf_counter() - start
+        seed = None
+        converged = maze.convergence()['converged']
+    return elapsed, steps, converged
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=40, help='rows and columns of the maze')
+    parser.add_argument('--target', type=float, default=0.95, help='fraction of cells converged')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[1, 2, 3], help='training seeds')
+    parser.add_argument('--chunk', type=int, default=5000, help='steps between convergence checks')
+    parser.add_argument('--limit', type=float, default=60, help='seconds before a run gives up')
+    args = parser.parse_args()
+
+    print(f'{args.size}x{args.size} maze, to {args.target} converged, mean of {len(args.seeds)} seeds')
+    print(f'{"planning":>12} {"seconds":>9} {"steps":>10} {"converged":>10} {"speedup":>8}')
+    base_seconds = None
+    for name, (planning_steps, sweeping) in MODES.items():
+        runs = [converge(args.size, planning_steps, sweeping, seed, args.target, args.chunk, args.limit)
+                for seed in args.seeds]
+        seconds, steps, converged = [sum(values) / len(runs) for values in zip(*runs)]
+        base_seconds = base_seconds or seconds
+        print(f'{name:>12} {seconds:>9.2f} {steps:>10.0f} {converged:>10.2f} {base_seconds / seconds:>8.2f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""
+Benchmark maze generation, training, solving and serialization across maze sizes.
+
+    python benchmarks/suite.py [--sizes 10 30 100 300 1000] [--output bench_output.json]
+                               [--baseline benchmarks/baseline.json] [--save-baseline]
+
+Every case runs on a maze generated from the same seed and trained with the same seed, so
+results only change with the code and the machine.  Each case reports the best time over
+--repeat runs, steps per second for training, and peak memory traced by tracemalloc in a
+separate run.  Fast cases are timed over loops of many calls, see measure, so a run is
+never shorter than the timer and scheduler noise.  Results are written as json and compared
+with the baseline, any case slower or larger than the baseline by more than --tolerance is
+reported and the exit status is 1.  Times under --min-seconds in both are not compared,
+at that scale a few cache misses or an interrupt change the time by more than the tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+from maze import Maze
+
+MAZE_SEED = 1
+TRAIN_SEED = 2
+# training cases stop after these many steps, so large mazes take bounded time
+TRAIN_PASSES = 10
+TRAIN_EPISODE_STEPS = 10000
+BATCH_SIZE = 64
+BATCH_EPISODE_STEPS = 2000
+# metrics compared with the baseline, and whether higher is better
+METRICS = {'seconds': False, 'peak_bytes': False, 'steps_per_second': True}
+# the least time measured for each timing of a case, as timeit.Timer.autorange
+MIN_TIME = 0.2
+
+def measure(run, repeat, setup = None, steps = False):
+    """
+    Time run() as the best of repeat timings, then trace its peak memory in one more run.
+    Each timing loops run() enough times to take at least MIN_TIME, and the time per call is kept.
+    setup() is called before every run, untimed, so each run is timed on its own, at least repeat
+    times and until the runs take MIN_TIME in all.  With steps, run returns the number of steps taken.
+    Return a result dictionary.
+    """
+    best = None
+    if setup:
+        runs = total = 0
+        while runs < repeat or total < MIN_TIME:
+            setup()
+            start = time.perf_counter()
+            count = run()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+            runs += 1
+            total += elapsed
+    else:
+        timer = timeit.Timer(run)
+        loops, _ = timer.autorange()
+        best = min(timer.repeat(repeat, loops)) / loops
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    result = {'seconds': best, 'peak_bytes': peak}
+    if steps:
+        result['steps'] = count
+        result['steps_per_second'] = count / best
+    return result
+
+def new_maze(size):
+    "a generated maze, the same for every run"
+    maze = Maze({'rows': size, 'cols': size})
+    maze.make_maze(seed=MAZE_SEED)
+    return maze
+
+def maze_cases(size, repeat, json_limit):
+    "benchmarks of the Maze methods for one size, as (name, result) pairs"
+    maze = new_maze(size)
+    yield 'make_maze', measure(lambda: maze.make_maze(seed=MAZE_SEED), repeat)
+
+    def reset():
+        maze.make_maze(seed=MAZE_SEED)
+        maze.hp.epsilon = 0.3
+    yield 'rl_train', measure(lambda: maze.rl_train(TRAIN_PASSES, 1, TRAIN_SEED, TRAIN_EPISODE_STEPS),
+                              repeat, reset, True)
+    yield 'rl_train_batch', measure(lambda: maze.rl_train(BATCH_SIZE, BATCH_SIZE, TRAIN_SEED, BATCH_EPISODE_STEPS),
+                                    repeat, reset, True)
+
+    # solve on a trained maze, a version change drops the cached solution
+    reset()
+    maze.rl_train(BATCH_SIZE, BATCH_SIZE, TRAIN_SEED, BATCH_EPISODE_STEPS)
+    max_steps = 4 * size * size
+    yield 'solve_from', measure(lambda: maze.solve_from(0, 0, max_steps), repeat, maze.changed)
+    yield 'solve_from_cached', measure(lambda: maze.solve_from(0, 0, max_steps), repeat)
+
+    if size * size <= json_limit:
+        yield 'dict_for_json', measure(maze.dict_for_json, repeat)
+    yield 'dict_for_compact_json', measure(maze.dict_for_compact_json, repeat)
+
+def endpoint_cases(size, repeat):
+    "end to end benchmarks of the Flask endpoints for one size, through the test client"
+    from app import app
+    client = app.test_client()
+
+    def check(response, status = 200):
+        assert response.status_code == status, f'{response.status_code} {response.get_data(as_text=True)[:200]}'
+        return response
+
+    def create():
+        return check(client.post('/create', json={'rows': size, 'cols': size, 'seed': MAZE_SEED}), 201).json['id']
+    yield 'POST /create', measure(create, repeat)
+    maze_id = None
+
+    def recreate():
+        "train a fresh maze in every run"
+        nonlocal maze_id
+        if maze_id:
+            check(client.delete(f'/maze/{maze_id}'), 204)
+        maze_id = create()
+
+    def train():
+        job = check(client.post(f'/train/{maze_id}', json={'passes': BATCH_SIZE, 'batch_size': BATCH_SIZE,
+                                                           'seed': TRAIN_SEED,
+                                                           'max_episode_steps': BATCH_EPISODE_STEPS}), 202).json
+        while job['state'] in ('queued', 'running'):
+            time.sleep(0.001)
+            job = check(client.get(f'/jobs/{job["id"]}')).json
+        assert job['state'] == 'done', job
+        return job['steps']
+    yield 'POST /train', measure(train, repeat, recreate, True)
+
+    yield 'GET /maze', measure(lambda: check(client.get(f'/maze/{maze_id}')), repeat)
+    yield 'GET /maze compact', measure(lambda: check(client.get(f'/maze/{maze_id}?format=compact&q_dtype=float32')),
+                                       repeat)
+    yield 'GET /policy', measure(lambda: check(client.get(f'/policy/{maze_id}')), repeat)
+    yield 'GET /convergence', measure(lambda: check(client.get(f'/convergence/{maze_id}')), repeat)
+    yield 'POST /solve', measure(lambda: check(client.post(f'/solve/{maze_id}',
+                                                           json={'x': 0, 'y': 0, 'max_steps': 4 * size * size})),
+                                 repeat)
+    check(client.delete(f'/maze/{maze_id}'), 204)
+
+def compare(results, baseline, tolerance, min_seconds = 0.0):
+    """
+    Return a list of regression descriptions for results worse than the baseline beyond tolerance.
+    Times, and the steps per second from them, are only compared when either time is at least min_seconds.
+    """
+    previous = {(case['name'], case['size']): case for case in baseline['results']}
+    regressions = []
+    for case in results:
+        old = previous.get((case['name'], case['size']))
+        if not old:
+            continue
+        timed = max(case['seconds'], old['seconds']) >= min_seconds
+        for metric, higher_is_better in METRICS.items():
+            if metric not in case or not old.get(metric):
+                continue
+            if metric != 'peak_bytes' and not timed:
+                continue
+            ratio = case[metric] / old[metric]
+            if (ratio < 1 / (1 + tolerance)) if higher_is_better else (ratio > 1 + tolerance):
+                regressions.append(f'{case["name"]} {case["size"]}x{case["size"]} {metric}: '
+                                   f'{old[metric]:.4g} -> {case[metric]:.4g} ({ratio:.2f}x)')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 30, 100, 300, 1000],
+                        help='rows and columns of each maze')
+    parser.add_argument('--endpoint-sizes', type=int, nargs='*', default=[10, 30, 100],
+                        help='maze sizes for the endpoint benchmarks')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each case, the best time is kept')
+    parser.add_argument('--json-limit', type=int, default=300 * 300,
+                        help='largest maze, in cells, for dict_for_json')
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--baseline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json'))
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed fractional slowdown or growth before a case counts as a regression')
+    parser.add_argument('--min-seconds', type=float, default=0.01,
+                        help='times under this in both the results and the baseline are not compared')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results as the new baseline')
+    args = parser.parse_args()
+
+    # keep the endpoint benchmarks from writing snapshots into the working directory
+    os.environ.setdefault('SNAPSHOT_DIR', tempfile.mkdtemp(prefix='maze-bench-'))
+    os.environ.setdefault('CHECKPOINT_INTERVAL', '0')
+
+    cases = [(size, maze_cases(size, args.repeat, args.json_limit)) for size in args.sizes]
+    cases += [(size, endpoint_cases(size, args.repeat)) for size in args.endpoint_sizes]
+    results = []
+    print(f'{"case":<24} {"size":>9} {"seconds":>10} {"steps/s":>10} {"peak MB":>9}')
+    for size, sized_cases in cases:
+        for name, result in sized_cases:
+            results.append(dict(name=name, size=size, **result))
+            rate = f'{result["steps_per_second"]:>10.0f}' if 'steps_per_second' in result else f'{"":>10}'
+            print(f'{name:<24} {f"{size}x{size}":>9} {result["seconds"]:>10.4f} {rate} '
+                  f'{result["peak_bytes"] / 1e6:>9.1f}', flush=True)
+
+    report = {'machine': {'python': platform.python_version(),
+                          'numpy': np.__version__,
+                          'platform': platform.platform(),
+                          'processor': platform.processor(),
+                          'cpus': os.cpu_count()},
+              'settings': {'repeat': args.repeat},
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f'results written to {args.output}')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=1)
+        print(f'baseline written to {args.baseline}')
+        return
+    if not os.path.exists(args.baseline):
+        print(f'no baseline at {args.baseline}, run with --save-baseline to create one')
+        return
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance, args.min_seconds)
+    if regressions:
+        print(f'{len(regressions)} regressions against {args.baseline}:')
+        for regression in regressions:
+            print('  ' + regression)
+        sys.exit(1)
+    print(f'no regressions against {args.baseline}')
+
+if __name__ == '__main__':
+    main()
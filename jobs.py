@@ -0,0 +1,244 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from metrics import registry, STEPS_BUCKETS
+from parallel import ParallelTrainer
+from profiler import SamplingProfiler
+
+# defines TrainingJob and JobManager classes
+#
+# Training runs as a job on a worker pool instead of in the request thread.
+# A job trains its maze in short chunks of steps, holding the maze lock for
+# one chunk at a time, and the episodes running at the end of a chunk
+# carry on in the next, see Maze.rl_train.  Requests on the same maze, such as
+# a solve, get the lock between chunks and always see a q table from a chunk
+# boundary.  Progress is published after every chunk and the job can be
+# cancelled between chunks.  Chunks are sized to take about chunk_seconds,
+# or with a seed follow a fixed schedule so the job is reproducible.
+# With more than one worker process a chunk is one ParallelTrainer round,
+# which holds the maze lock only to copy the q table in and merge it back.
+# A job keeps only the id of its maze.  It pins the maze in the registry while
+# it runs, so the maze isn't evicted, and stops if the maze is deleted.
+# A job can also train until the greedy policy reaches the goal from a given
+# fraction of the cells, with passes as the upper limit, see Maze.convergence.
+# Every chunk is recorded in the training metrics, and a job can be profiled
+# by sampling the stack of the thread running it, see SamplingProfiler.
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+CANCELLED = 'cancelled'
+FAILED = 'failed'
+FINISHED_STATES = (DONE, CANCELLED, FAILED)
+
+# training metrics
+training_steps = registry.counter('maze_training_steps_total', 'Environment steps taken in training.')
+training_passes = registry.counter('maze_training_passes_total', 'Training passes (episodes) run.')
+training_seconds = registry.counter('maze_training_seconds_total', 'Time spent training, holding the maze lock.')
+training_rate = registry.gauge('maze_training_steps_per_second', 'Steps per second of the last training chunk.')
+episode_lengths = registry.histogram('maze_training_episode_length_steps', 'Steps in each training pass.',
+                                     buckets=STEPS_BUCKETS)
+training_jobs = registry.counter('maze_training_jobs_total', 'Training jobs finished, by final state.', ('state',))
+
+class TrainingJob:
+    "a request to train a maze for a number of passes, with its progress"
+
+    def __init__(self, registry, maze_id, passes, batch_size = 1, workers = 1, sync_passes = 100, seed = None,
+                 until_converged = None, max_episode_steps = None, chunk_seconds = 0.2, check_seconds = 1.0,
+                 first_chunk = 1000, seeded_chunk = 20000, profile = False):
+        self.id = uuid.uuid4().hex
+        self.registry = registry # MazeRegistry holding the maze
+        self.maze_id = maze_id
+        self.passes = passes
+        self.batch_size = batch_size
+        self.workers = workers # processes, see ParallelTrainer
+        self.sync_passes = sync_passes
+        self.seed = seed
+        self.until_converged = until_converged # fraction of cells, stop once reached
+        self.max_episode_steps = max_episode_steps
+        self.chunk_seconds = chunk_seconds # target time the maze lock is held
+        self.check_seconds = check_seconds # minimum time between convergence checks
+        self.first_chunk = first_chunk # steps in the first chunk, and the fewest in any chunk
+        self.seeded_chunk = seeded_chunk # largest chunk in steps with a seed, including planning steps
+        self.profiler = SamplingProfiler() if profile else None # samples the thread running the job
+        self.convergence = None # last result of Maze.convergence
+        self.state = QUEUED
+        self.passes_done = 0
+        self.total_training_passes = None # of the maze at the last chunk
+        self.steps = 0
+        self.run_time = 0.0 # seconds spent training
+        self.error = None
+        self.version = 0 # incremented whenever the status changes
+        self.changed = threading.Condition()
+        self.cancel_requested = threading.Event()
+
+    def status(self):
+        "dictionary of the job status for json"
+        return {'id': self.id,
+                'maze_id': self.maze_id,
+                'state': self.state,
+                'passes': self.passes,
+                'workers': self.workers,
+                'passes_done': self.passes_done,
+                'steps': self.steps,
+                'steps_per_second': self.steps / self.run_time if self.run_time else 0,
+                'average_episode_length': self.steps / self.passes_done if self.passes_done else 0,
+                'total_training_passes': self.total_training_passes,
+                'until_converged': self.until_converged,
+                'convergence': self.convergence,
+                'profile': self.profiler is not None,
+                'error': self.error}
+
+    def finished(self):
+        "True once the job has stopped for any reason"
+        return self.state in FINISHED_STATES
+
+    def converged(self):
+        "True if the job trains until converged and the policy has converged"
+        return (self.until_converged is not None and self.convergence is not None and
+                self.convergence['converged'] >= self.until_converged)
+
+    def cancel(self):
+        "ask the job to stop at the next chunk boundary"
+        self.cancel_requested.set()
+        with self.changed:
+            if self.state == QUEUED:
+                self.set_state(CANCELLED)
+
+    def set_state(self, state):
+        "record a status change and wake anyone waiting on it. Hold self.changed."
+        self.state = state
+        self.version += 1
+        self.changed.notify_all()
+
+    def wait_for_change(self, version, timeout = None):
+        "wait until the status version differs from version, return the current version"
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def run(self):
+        "train the maze in chunks until done or cancelled"
+        with self.changed:
+            if self.state != QUEUED:
+                training_jobs.inc(state=self.state)
+                return # cancelled before it started
+            self.set_state(RUNNING)
+        entry = self.registry.pin(self.maze_id)
+        if not entry:
+            with self.changed:
+                self.error = f'maze {self.maze_id} was evicted or deleted before training started'
+                self.set_state(FAILED)
+            training_jobs.inc(state=self.state)
+            return
+        maze = entry.maze
+        trainer = None
+        # from here on every failure ends the job and unpins the maze
+        try:
+            seed = self.seed # only seeds the first chunk, the random sources carry on after it
+            episodes = None # episodes left running by the last chunk
+            chunk = self.first_chunk # steps, or passes for a ParallelTrainer round
+            seeded_chunk = self.seeded_chunk
+            if self.batch_size == 1:
+                seeded_chunk = max(1, seeded_chunk // (1 + maze.hp.planning_steps))
+            last_check = time.perf_counter()
+            if self.profiler:
+                self.profiler.start()
+            if self.until_converged is not None:
+                with entry.lock:
+                    distances = maze.goal_distances()
+                    self.convergence = maze.convergence()
+                if not self.max_episode_steps:
+                    # long enough to reach the goal from anywhere while exploring
+                    self.max_episode_steps = 4 * int(distances.max()) + 100
+            if self.workers > 1:
+                trainer = ParallelTrainer(maze, self.workers, self.sync_passes, seed)
+                chunk = self.sync_passes
+            while (self.passes_done < self.passes and not self.cancel_requested.is_set() and
+                   not self.converged()):
+                if not self.registry.holds(entry):
+                    self.error = f'maze {self.maze_id} was deleted'
+                    break
+                remaining = self.passes - self.passes_done
+                if trainer:
+                    # the trainer takes the maze lock only to copy the q table and merge the round
+                    start = time.perf_counter()
+                    steps = trainer.train(min(chunk, remaining), self.batch_size, self.max_episode_steps, entry.lock)
+                    lengths = trainer.episode_lengths
+                with entry.lock:
+                    if not trainer:
+                        start = time.perf_counter()
+                        steps = maze.rl_train(remaining, self.batch_size, seed, self.max_episode_steps, chunk, episodes)
+                        episodes = maze.unfinished
+                        lengths = maze.episode_lengths
+                    elapsed = time.perf_counter() - start
+                    passes = len(lengths)
+                    total_training_passes = maze.total_training_passes
+                    if self.until_converged is not None and (time.perf_counter() - last_check >= self.check_seconds or
+                                                             self.seed is not None or passes >= remaining):
+                        convergence = maze.convergence()
+                        last_check = time.perf_counter()
+                    else:
+                        convergence = self.convergence
+                seed = None
+                training_steps.inc(steps)
+                training_passes.inc(passes)
+                training_seconds.inc(elapsed)
+                training_rate.set(steps / max(elapsed, 1e-9))
+                episode_lengths.observe_many(lengths)
+                if trainer:
+                    pass # a round is always sync_passes
+                elif self.seed is not None:
+                    # chunk boundaries don't depend on timing, so convergence checks fall at the same steps
+                    chunk = min(chunk * 2, seeded_chunk)
+                else:
+                    # size the next chunk to take about chunk_seconds
+                    chunk = max(self.first_chunk, min(chunk * 2, int(steps * self.chunk_seconds / max(elapsed, 1e-6))))
+                with self.changed:
+                    self.passes_done += passes
+                    self.total_training_passes = total_training_passes
+                    self.steps += steps
+                    self.run_time += elapsed
+                    self.convergence = convergence
+                    self.set_state(RUNNING)
+            with self.changed:
+                self.set_state(DONE if self.passes_done == self.passes or self.converged() else CANCELLED)
+        except Exception as e:
+            with self.changed:
+                self.error = str(e)
+                self.set_state(FAILED)
+        finally:
+            if trainer:
+                trainer.close()
+            if self.profiler:
+                self.profiler.stop()
+            self.registry.unpin(entry)
+            training_jobs.inc(state=self.state)
+
+class JobManager:
+    "runs training jobs on a pool of worker threads and keeps them by id"
+
+    def __init__(self, registry, workers = 2, max_jobs = 1000):
+        self.registry = registry # MazeRegistry holding the mazes trained
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='training')
+        self.max_jobs = max_jobs # finished jobs beyond this are forgotten, oldest first
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, maze_id, passes, **options):
+        "queue a training job for a maze in the registry and return it, options are passed to TrainingJob"
+        job = TrainingJob(self.registry, maze_id, passes, **options)
+        with self.lock:
+            self.jobs[job.id] = job
+            finished = [job_id for job_id, old in self.jobs.items() if old.finished()]
+            for job_id in finished[:max(0, len(self.jobs) - self.max_jobs)]:
+                del self.jobs[job_id]
+        self.executor.submit(job.run)
+        return job
+
+    def get(self, job_id):
+        "return a job by id, None if unknown"
+        with self.lock:
+            return self.jobs.get(job_id)
@@ -131,7 +131,10 @@ class RLHyperP {
         rIllegal = -0.75,
         rLegal = -0.1,
         rGoal = 10,
-        hiddenSize = 64) {
+        hiddenSize = 64,
+        planning_steps = 0,
+        prioritized_sweeping = false,
+        priority_threshold = 1e-12) {
         this.epsilon = epsilon;
         this.epsilon_decay = epsilon_decay;
         this.min_epsilon = min_epsilon;
@@ -141,6 +144,9 @@ class RLHyperP {
         this.rLegal = rLegal;
         this.rGoal = rGoal;
         this.hiddenSize = hiddenSize;
+        this.planning_steps = planning_steps;
+        this.prioritized_sweeping = prioritized_sweeping;
+        this.priority_threshold = priority_threshold;
     }
 }
 
@@ -155,7 +161,10 @@ const solutionTimeoutBanner = document.getElementById('solution-timeout');
 solutionTimeoutBanner.hidden = true;
 const trainingBanner = document.getElementById('training-banner');
 const trainingPasses = document.getElementById('training-passes');
+const trainingProgress = document.getElementById('training-progress');
+const cancelTrainingButton = document.getElementById('cancel-training');
 trainingBanner.hidden = true;
+cancelTrainingButton.hidden = true;
 const downloadContainer = document.getElementById('download-container');
 let totalTrainingPasses = 0;
 const rlHP = new RLHyperP(); // to be filled with form and included in download
@@ -179,8 +188,9 @@ function hpFormDefaults(rlHP) {
     hpForm.hiddenSize.value = rlHP.hiddenSize;
 }
 
-function trainFormDefault(passes = 2000) {
+function trainFormDefault(passes = 2000, batchSize = 1) {
     trainForm.passes.value = passes;
+    trainForm.batchSize.value = batchSize;
 }
 
 function solveFormDefaults(startx = 0, starty = 0, limit = 1000) {
@@ -307,10 +317,47 @@ hpForm.addEventListener('submit', (event) => {
     }
 });
 
+// follow the progress of a training job through server sent events
+let trainingJobId = null;
+function followTrainingJob(jobId) {
+    trainingJobId = jobId;
+    cancelTrainingButton.hidden = false;
+    trainingBanner.hidden = false;
+    const events = new EventSource(APIURL + '/jobs/' + jobId + '/events');
+    events.onmessage = (event) => {
+        const job = JSON.parse(event.data);
+        totalTrainingPasses = job.total_training_passes;
+        trainingPasses.innerText = totalTrainingPasses;
+        trainingProgress.innerText = `${job.state}, ${job.passes_done} of ${job.passes} passes, ` +
+            `${Math.round(job.steps_per_second)} steps/s, average episode ${Math.round(job.average_episode_length)} steps`;
+        if (['done', 'cancelled', 'failed'].includes(job.state)) {
+            console.log('Training finished', job);
+            events.close();
+            trainingJobId = null;
+            cancelTrainingButton.hidden = true;
+            showButtons();
+            updateDownloadLink();
+        }
+    };
+    events.onerror = (error) => {
+        console.error('Error:', error);
+    };
+}
+
+cancelTrainingButton.addEventListener('click', () => {
+    if (trainingJobId !== null) {
+        fetch(APIURL + '/jobs/' + trainingJobId, { method: 'DELETE' })
+        .catch(error => {
+            console.error('Error:', error);
+        });
+    }
+});
+
 trainForm.addEventListener('submit', (event) => {
     event.preventDefault();
 
     let passes = Number(event.target.passes.value);
+    let batchSize = Number(event.target.batchSize.value);
     console.log("passes to run: ", passes);
 
     if (!maze.generated) {
@@ -318,27 +365,24 @@ trainForm.addEventListener('submit', (event) => {
     }
     else {
         hideButtons();
-        trainURL = APIURL + '/train';
-        trainData = {passes: passes};
+        trainURL = APIURL + '/train/' + maze.id;
+        trainData = {passes: passes, batch_size: batchSize};
         fetch(trainURL, { method: 'POST',
                            headers: {'Content-Type': 'application/json'},
                            body: JSON.stringify(trainData)})
         .then(response => response.json())
-        .then(data => {
-            console.log('Training completed', data);
-            showButtons();
-            totalTrainingPasses = data.total_training_passes;
-            trainingPasses.innerText = totalTrainingPasses;
-            trainingBanner.hidden = false;
-            updateDownloadLink();
+        .then(job => {
+            console.log('Training job submitted', job);
+            followTrainingJob(job.id);
         })
         .catch(error => {
             console.error('Error:', error);
+            showButtons();
         }); // runs async
         console.log("Training started");
     }
     trainForm.reset();
-    trainFormDefault(passes);
+    trainFormDefault(passes, batchSize);
 });
 
 
@@ -356,7 +400,7 @@ solveForm.addEventListener('submit', (event) => {
         console.error("Error: maze not defined");
     }
     else {
-        solveURL = APIURL + '/solve';
+        solveURL = APIURL + '/solve/' + maze.id;
         solveData = {x: startx, y:starty, max_steps: limit};
         solutionCompleteBanner.hidden = true;
         solutionTimeoutBanner.hidden = true;
@@ -1,19 +1,58 @@
+import base64
 import random
-
-# defines Maze and MazeCell classes
+import uuid
+from array import array
+from collections import OrderedDict
+import numpy as np
+
+# defines Maze, MazeCell and Planner classes
+#
+# The maze is held in a few numpy arrays rather than one object per cell:
+#   legal - uint8 (rows, cols), bit i is set when MazeCell.moves[i] is open
+#   q     - float64 (rows, cols, 4), q values indexed by move number
+#   q_version - int32 (rows, cols), the maze version when the cell's q values last changed
+#   observed - uint8 (rows, cols), bit i is set once move i has been taken from the cell
+#              in training with planning, the model replayed by train_planning
+# Hot loops work on flat state numbers (y * cols + x) through memoryviews
+# of these arrays, which is much cheaper than dict or numpy scalar access.
+
+# q values stay in double precision, with float32 the q values of unexplored
+# loops saturate into exact ties and greedy tie breaking stops exploring
+Q_DTYPE = np.float64
+
+# approximate bytes per cell of a maze with all its arrays, see Maze.nbytes:
+# legal 1, q 32, q_version 4, observed 1, paths 16, distances 4 and the policy map 16
+CELL_BYTES = 74
+# approximate bytes per location of a cached solution path, and the most kept for a maze,
+# least recently used solutions are dropped beyond it
+PATH_POINT_BYTES = 64
+SOLVE_CACHE_BYTES = 16 << 20
+# real steps between the rounds of simulated backups of Maze.train_planning
+PLANNING_INTERVAL = 64
+
+def no_episodes():
+    "(states, steps taken) arrays for no running training episodes, see Maze.rl_train"
+    return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+def encode_array(values):
+    "base64 text of the little endian bytes of a numpy array"
+    return base64.b64encode(values.astype(values.dtype.newbyteorder('<'), copy=False).tobytes()).decode('ascii')
 
 class RLHyperP:
     "a set of hyperparameters for reinforcement learning"
 
-    def __init__(self, epsilon = 0.3, 
-                epsilon_decay = 0.99, 
+    def __init__(self, epsilon = 0.3,
+                epsilon_decay = 0.99,
                 min_epsilon = 0.1,
-                alpha = 0.5, 
-                gamma = 0.9, 
-                rIllegal = -0.75, 
-                rLegal = -0.1, 
+                alpha = 0.5,
+                gamma = 0.9,
+                rIllegal = -0.75,
+                rLegal = -0.1,
                 rGoal = 10,
-                hiddenSize = 64):
+                hiddenSize = 64,
+                planning_steps = 0,
+                prioritized_sweeping = False,
+                priority_threshold = 1e-12):
         self.epsilon = epsilon
         self.epsilon_decay = epsilon_decay
         self.min_epsilon = min_epsilon
@@ -23,263 +62,946 @@ class RLHyperP:
         self.rLegal = rLegal
         self.rGoal = rGoal
         self.hiddenSize = hiddenSize
-        
+        self.planning_steps = planning_steps # simulated backups per real step, see Maze.train_planning
+        self.prioritized_sweeping = prioritized_sweeping
+        self.priority_threshold = priority_threshold # smallest q change queued, far from the goal q values differ very little
+
 class MazeCell:
-    "represent the content of a single maze cell"   
-    
+    """
+    A lightweight view of a single cell of a Maze.
+    All state lives in the maze arrays, the view only holds coordinates.
+    """
+
     # static moves
     # moves_by_name = { 's' : (0, 1), 'e' : (1, 0), 'n' : (0, -1), 'w' : (-1, 0) }
     move_names = {(0, 1): 's', (1, 0): 'e', (0, -1): 'n', (-1, 0): 'w'}
     moves = [(0, 1), (1, 0), (0, -1), (-1, 0)] # use the tuples as keys
     reverse_moves = {(0, 1): (0, -1), (0, -1): (0, 1), (1, 0): (-1, 0), (-1, 0): (1, 0)}
+    # bit for each move in Maze.legal, the reverse of move i is move (i + 2) % 4
+    move_bits = [1, 2, 4, 8]
 
-    def __init__(self, x, y, maze, hp = RLHyperP()):
+    def __init__(self, x, y, maze):
         self.x = x
         self.y = y
         self.maze = maze
-        self.hp = hp
-        self.legal = {(0, -1): False, (0, 1): False, (1, 0): False, (-1, 0): False}
-        self.q = {(0, -1) : 0, (0, 1) : 0, (1, 0) : 0, (-1, 0) : 0}
-        self.goal = False # goal cell
+
+    @property
+    def hp(self):
+        "hyperparameters are held once per maze"
+        return self.maze.hp
+
+    @property
+    def legal(self):
+        "dictionary of move tuple to legality"
+        bits = int(self.maze.legal[self.y, self.x])
+        return {move: bool(bits & MazeCell.move_bits[i]) for i, move in enumerate(MazeCell.moves)}
+
+    @property
+    def q(self):
+        "dictionary of move tuple to q value"
+        values = self.maze.q[self.y, self.x].tolist()
+        return {move: values[i] for i, move in enumerate(MazeCell.moves)}
+
+    @property
+    def goal(self):
+        "True for the goal cell"
+        return self.maze.state(self.x, self.y) == self.maze.goal_state
 
     def dict_for_json(self):
         """
         Create a dictionary for conversion to json.
-        Omit the maze object.
         Convert the RLHyperP to a dictionary.
         Convert legal and q keys to names (can't use tuples for json)
         """
-        result = self.__dict__.copy()
-        del(result['maze'])
-        result['hp'] = self.hp.__dict__
-        result['legal'] = {MazeCell.move_names[k]: v for k, v in result['legal'].items()}
-        result['q'] = {MazeCell.move_names[k]: v for k, v in result['q'].items()}
-        return result
+        return {'x': self.x,
+                'y': self.y,
+                'hp': self.hp.__dict__,
+                'legal': {MazeCell.move_names[k]: v for k, v in self.legal.items()},
+                'q': {MazeCell.move_names[k]: v for k, v in self.q.items()},
+                'goal': self.goal}
 
     def loc(self):
         "return a tuple for the location of the cell"
         return (self.x, self.y)
-    
-    def step(self, move):
-        "apply a legal move tuple to the current cell"
-        self.legal[move] = True # update legality
-        new_cell = MazeCell(self.x + move[0], self.y + move[1], self.maze)
-        new_cell.legal[MazeCell.reverse_moves[move]] = True
-        return new_cell
-        
-    def random_step(self):
-        "move at random to an adjacent cell, return False if no move available"    
-
-        if self.enclosed():
-            return False
-        
-        move = self.get_random_move()
-        while self.out_of_bounds_or_occupied(move):
-            move = self.get_random_move()
-        new_cell = self.step(move)
-        return new_cell
-
-    def out_of_bounds_or_occupied(self, move):
-        "check whether a potential move is in bounds and unoccupied"
-        new_x = self.x + move[0]
-        new_y = self.y + move[1]
-        if (new_x < 0 or
-            new_y < 0 or
-            new_x >= self.maze.cols or
-            new_y >= self.maze.rows or
-            self.maze.cell_matrix[new_y][new_x] != 0):
-            return True
-        else:
-            return False
-
-    def enclosed(self):
-        "return True if no moves are possible due to boundaries or occupancy"
-        return ((self.x == 0 or self.maze.cell_matrix[self.y][self.x - 1]) and
-                (self.x == self.maze.cols - 1 or self.maze.cell_matrix[self.y][self.x + 1]) and
-                (self.y == 0 or self.maze.cell_matrix[self.y - 1][self.x]) and
-                (self.y == self.maze.rows - 1 or self.maze.cell_matrix[self.y + 1][self.x]))
-
-    
-    # methods for Q learning follow
-    ###############################
 
-    def get_random_move(self):
-        "select a random move"
-        return random.choice(MazeCell.moves)
-
-    def get_random_legal_move(self):
-        "select a random move, but make sure it's legal"
-        return random.choice([move for move in MazeCell.moves if self.legal[move]])
-    
     def best_move(self, force_legal = False):
-        """
-        Select the best move based on q values.
-        If all q values are 0, select at random.
-        If force_legal is true, only legal values are selected when selecting randomly.
-        """
-                # return a random selection of all q's are zero
-        if all(val == 0 for val in self.q.values()):
-            if force_legal:
-                return self.get_random_legal_move()
-            else:
-                return self.get_random_move()
-        else:
-            return max(self.q, key=self.q.get)
-        
+        "select the best move tuple based on q values, see Maze.best_move"
+        return MazeCell.moves[self.maze.best_move(self.maze.state(self.x, self.y), force_legal)]
+
     def next_state(self, move):
         "apply a move to get the next state (cell).  Moves are tuples (x, y)"
-        return self.maze.cell_matrix[self.y + move[1]][self.x + move[0]]
-    
+        return self.maze.cell(self.x + move[0], self.y + move[1])
+
     def update_state(self):
         """
         Update the state based on the Bellman equation and epsilon greedy.
         Return the new cell.
         """
-
-        # select a move based on epsilon greedy
-        if random.random() < self.hp.epsilon:
-            # explore
-            move = self.get_random_move()
-        else:
-            # exploit
-            move = self.best_move()
-
-        # update epsilon
-        self.hp.epsilon *= self.hp.epsilon_decay
-
-        # compute reward
-        if self.legal[move]:
-            new_state = self.next_state(move)
-            if new_state.goal:
-                reward = self.hp.rGoal
-            else:
-                reward = self.hp.rLegal
-        else:
-            new_state = self # don't apply an illegal move
-            reward = self.hp.rIllegal
-
-        # update q
-        current_q = self.q[move]
-        new_state_q = new_state.q[new_state.best_move()]
-        new_q = current_q + self.hp.alpha * (reward + (self.hp.gamma * new_state_q) - current_q)
-        self.q[move] = new_q
-
-        return new_state
+        return self.maze.cell(*self.maze.loc(self.maze.update_state(self.maze.state(self.x, self.y))))
 
 class Maze:
     "represent and manipulate 2D mazes"
-    def __init__(self, definition = {'cols': 10, 'rows': 10}):
+    def __init__(self, definition = {'cols': 10, 'rows': 10}, hp = None):
         "definition is a dictionary containing row (rows) and column (cols) count"
         self.rows = definition['rows']
         self.cols = definition['cols']
-        # initialize the cell matrix to all zeros.  Each cell can be 0 or a MazeCell.
-        self.cell_matrix = [[0 for _ in range(self.cols)] for _ in range(self.rows)]
+        # hyperparameters, shared by every cell
+        self.hp = hp if hp else RLHyperP()
+        # open passages and q values for every cell, see the notes at the top
+        self.legal = np.zeros((self.rows, self.cols), dtype=np.uint8)
+        self.q = np.zeros((self.rows, self.cols, 4), dtype=Q_DTYPE)
+        # version is incremented whenever q values change, see q_version and dict_for_delta_json.
+        # A restored maze starts again from the version of its snapshot, so versions are only
+        # comparable within an epoch, which is new for every maze object
+        self.version = 0
+        self.epoch = uuid.uuid4().hex[:12]
+        self.q_version = np.zeros((self.rows, self.cols), dtype=np.int32)
+        self.observed = np.zeros((self.rows, self.cols), dtype=np.uint8)
+        # flat state offset for each move, in MazeCell.moves order
+        self.offsets = [self.cols, 1, -self.cols, -1]
+        # the goal is always the lower right corner for now
+        self.goal_state = self.state(self.cols - 1, self.rows - 1)
         # record the paths (sequences of cell locations) in the maze
-        self.paths = []
+        # as flat state numbers and the start of each path, see paths
+        self.path_cells = np.zeros(0, dtype=np.int64)
+        self.path_starts = np.zeros(0, dtype=np.int64)
+        self.distances = None # see goal_distances
         self.total_training_passes = 0
+        self.episode_lengths = np.zeros(0, dtype=np.int64) # steps in each pass of the last rl_train
+        self.unfinished = no_episodes() # episodes left running by the last rl_train, see rl_train
         self.generated = False
         self.solve_path = [] # list of (x, y) tuples
+        # greedy policy results, dropped when the version changes, see policy_map and cached_solution
+        self.policy_version = None
+        self.policy = None
+        self.solve_cache = OrderedDict() # key to (solution, approximate bytes), least recently used first
+        self.solve_cache_version = None
+        self.solve_cache_bytes = 0
+        # random sources for training, reseeded by rl_train when given a seed
+        self.random = random.Random()
+        self.np_random = np.random.default_rng()
+        # ties broken at random while solving, apart from training so solves don't change seeded training
+        self.solve_random = random.Random()
 
     def dict_for_json(self):
         """
         Create a dictionary for use with flask jasonify.
-        Convert MazeCells in cell_matrix to dictionaries.
-        """
-        result = self.__dict__.copy()
-        result['cell_matrix'] = [[cell.dict_for_json() for cell in row] for row in self.cell_matrix]
-        return result
-
-    def place_cell(self, maze_cell):
-        "place a MazeCell in the cell_matrix at its x, y coordinates"
-        self.cell_matrix[maze_cell.y][maze_cell.x] = maze_cell
-        #print(f'placed cell at {maze_cell.x}, {maze_cell.y}')
-
-    def get_new_start(self):
-        "get a new starting point for a maze path from among occupied, unenclosed cells"
-        candidates = [cell for row in self.cell_matrix for cell in row if (cell != 0 and not cell.enclosed())]
-        if len(candidates) > 0:
-            return random.choice(candidates)
-        else:
-            return False
-
-    def make_maze_path(self, start):
-        "save the path"
-        path = []
-
-        "given a mazeCell, create a random path until it becomes enclosed"
-        current_cell = start
-
-        # loop until enclosed
-        while current_cell:
-            self.place_cell(current_cell)
-            path.append(current_cell.loc())
-            current_cell = current_cell.random_step()
-
-        self.paths.append(path)
-
-    def make_maze(self, start):
-        "reinitialize the cell_matrix"
-        self.cell_matrix = [[0 for _ in range(self.cols)] for _ in range(self.rows)]
-        "fill the entire maze extending unenclosed points until none remain"
-        self.make_maze_path(start)
-        new_start = self.get_new_start()
-        while new_start:
-            self.make_maze_path(new_start)
-            new_start = self.get_new_start()
-        # mark the goal cell, always lr corner for now
-        self.cell_matrix[self.cols - 1][self.rows - 1].goal = True
+        Expand the maze arrays into a matrix of cell dictionaries.
+        """
+        hp = self.hp.__dict__
+        names = [MazeCell.move_names[move] for move in MazeCell.moves]
+        bits = MazeCell.move_bits
+        legal = self.legal.tolist()
+        q = self.q.tolist()
+        goal_x, goal_y = self.loc(self.goal_state)
+        cell_matrix = [[{'x': x,
+                         'y': y,
+                         'hp': hp,
+                         'legal': {name: bool(legal[y][x] & bits[i]) for i, name in enumerate(names)},
+                         'q': dict(zip(names, q[y][x])),
+                         'goal': x == goal_x and y == goal_y}
+                        for x in range(self.cols)] for y in range(self.rows)]
+        return {'rows': self.rows,
+                'cols': self.cols,
+                'cell_matrix': cell_matrix,
+                'paths': self.paths,
+                'total_training_passes': self.total_training_passes,
+                'generated': self.generated,
+                'solve_path': self.solve_path}
+
+    def dict_for_compact_json(self, q_dtype = 'float64'):
+        """
+        Create a compact dictionary for use with flask jsonify, arrays are base64 encoded little endian.
+        legal holds two cells per byte, the first in the low 4 bits.
+        q is a (rows, cols, 4) array of q_dtype, float16, float32 or float64.
+        paths are flat state numbers as int32 with the start of each path.
+        """
+        legal = self.legal.reshape(-1)
+        if len(legal) % 2:
+            legal = np.append(legal, np.uint8(0))
+        packed = legal[0::2] | (legal[1::2] << 4)
+        return {'format': 'compact',
+                'rows': self.rows,
+                'cols': self.cols,
+                'epoch': self.epoch,
+                'version': self.version,
+                'hp': self.hp.__dict__,
+                'goal': self.loc(self.goal_state),
+                'legal': encode_array(packed),
+                'q_dtype': q_dtype,
+                'q': encode_array(self.q.astype(q_dtype)),
+                'path_cells': encode_array(self.path_cells.astype(np.int32)),
+                'path_starts': encode_array(self.path_starts.astype(np.int32)),
+                'total_training_passes': self.total_training_passes,
+                'generated': self.generated}
+
+    def dict_for_delta_json(self, since, q_dtype = 'float64'):
+        """
+        Create a dictionary of the q values changed since an earlier version, for use with flask jsonify.
+        cells are the flat state numbers of the changed cells as int32, q their (n, 4) q values,
+        encoded as in dict_for_compact_json.
+        """
+        cells = np.flatnonzero(self.q_version.reshape(-1) > since)
+        return {'format': 'delta',
+                'since': since,
+                'epoch': self.epoch,
+                'version': self.version,
+                'cells': encode_array(cells.astype(np.int32)),
+                'q_dtype': q_dtype,
+                'q': encode_array(self.q.reshape(-1, 4)[cells].astype(q_dtype)),
+                'total_training_passes': self.total_training_passes}
+
+    def nbytes(self):
+        "approximate memory used by the maze in bytes, including the cached distances, policy map and solutions"
+        arrays = [self.legal, self.q, self.q_version, self.observed, self.path_cells, self.path_starts]
+        if self.distances is not None:
+            arrays.append(self.distances)
+        if self.policy is not None:
+            arrays += self.policy
+        return sum(values.nbytes for values in arrays) + self.solve_cache_bytes # solve_path is cached
+
+    @staticmethod
+    def estimated_nbytes(rows, cols):
+        "approximate memory a rows by cols maze will use in bytes, before it is built"
+        return rows * cols * CELL_BYTES
+
+    def changed(self):
+        "start a new version for a change to the q values, return the version number"
+        self.version += 1
+        return self.version
+
+    def state(self, x, y):
+        "flat state number for an x, y location"
+        return y * self.cols + x
+
+    def loc(self, state):
+        "x, y location for a flat state number"
+        return (state % self.cols, state // self.cols)
+
+    def cell(self, x, y):
+        "return a MazeCell view of the cell at x, y"
+        return MazeCell(x, y, self)
+
+    # maze generation
+    # paths are random walks that continue until they are enclosed.  Each new path
+    # starts from a random occupied cell with an unoccupied neighbor, taken from a
+    # frontier list, so generation is linear in the number of cells.
+    # Generation works on a grid padded with an occupied border so no bounds checks
+    # are needed, the padding is stripped when the walk is complete.
+    ###############################
+
+    def make_maze(self, start = (0, 0), seed = None):
+        "fill the entire maze extending unenclosed points until none remain, seed makes it reproducible"
+        rng = random.Random(seed)
+        rand = rng.random
+        width = self.cols + 2
+        offsets = [width, 1, -width, -1]
+        # offsets of the free neighbors for each mask of occupied neighbors
+        free_offsets = [tuple(offsets[i] for i in range(4) if not mask & (1 << i)) for mask in range(16)]
+
+        # occupancy of the padded grid, the border is occupied
+        occupied = bytearray([1]) * (width * (self.rows + 2))
+        for y in range(1, self.rows + 1):
+            occupied[y * width + 1:y * width + width - 1] = bytes(self.cols)
+        path_cells = array('q') # padded cell numbers of all paths, in order
+        path_starts = array('q') # start of each path in path_cells
+        append = path_cells.append
+        frontier = [] # occupied cells which may still have an unoccupied neighbor
+
+        cell = (start[1] + 1) * width + start[0] + 1
+        while True:
+            # walk a path until it is enclosed
+            path_starts.append(len(path_cells))
+            while True:
+                occupied[cell] = 1
+                append(cell)
+                mask = (occupied[cell + width] | occupied[cell + 1] << 1 |
+                        occupied[cell - width] << 2 | occupied[cell - 1] << 3)
+                if mask == 15:
+                    break
+                free = free_offsets[mask]
+                if len(free) > 1:
+                    frontier.append(cell)
+                    cell += free[int(rand() * len(free))]
+                else:
+                    cell += free[0]
+
+            # find a new start, dropping frontier cells which have become enclosed
+            while frontier:
+                index = int(rand() * len(frontier))
+                cell = frontier[index]
+                if (not occupied[cell + width] or not occupied[cell + 1] or
+                    not occupied[cell - width] or not occupied[cell - 1]):
+                    break
+                frontier[index] = frontier[-1]
+                frontier.pop()
+            else:
+                break
+
+        # open the walls between consecutive cells of each path
+        cells = np.frombuffer(path_cells, dtype=np.int64)
+        starts = np.frombuffer(path_starts, dtype=np.int64)
+        within = np.ones(len(cells) - 1, dtype=bool)
+        within[starts[1:] - 1] = False
+        here = cells[:-1][within]
+        there = cells[1:][within]
+        step = there - here
+        legal = np.zeros(len(occupied), dtype=np.uint8)
+        for i, offset in enumerate(offsets):
+            # each cell has at most one passage in a given direction, so no repeated indices
+            moved = step == offset
+            legal[here[moved]] |= MazeCell.move_bits[i]
+            legal[there[moved]] |= MazeCell.move_bits[(i + 2) % 4]
+
+        # strip the padding
+        self.legal[:] = legal.reshape(self.rows + 2, width)[1:-1, 1:-1]
+        self.path_cells = (cells // width - 1) * self.cols + (cells % width - 1)
+        self.path_starts = starts.copy()
+        self.distances = None
+        self.q[:] = 0
+        self.q_version[:] = self.changed()
+        self.observed[:] = 0
         self.generated = True
 
+    @property
+    def paths(self):
+        "the paths (lists of x, y cell locations) that were walked to generate the maze"
+        xs = (self.path_cells % self.cols).tolist()
+        ys = (self.path_cells // self.cols).tolist()
+        ends = self.path_starts[1:].tolist() + [len(xs)]
+        return [list(zip(xs[begin:end], ys[begin:end])) for begin, end in zip(self.path_starts.tolist(), ends)]
+
     # methods for Q learning follow
+    # states are flat cell numbers, moves are indices into MazeCell.moves
     ###############################
 
-    def get_random_cell(self):
-        "return a random cell from the cell_matrix"
-        return random.choice(random.choice(self.cell_matrix))
-    
-    
+    def get_random_state(self):
+        "return a random state"
+        return self.random.randrange(self.rows * self.cols)
+
+    def best_move(self, state, force_legal = False, rng = None):
+        """
+        Select the best move number based on q values.
+        If all q values are 0, select at random from rng, by default the training source self.random.
+        If force_legal is true, only legal moves are selected, randomly or by q value.
+        """
+        values = self.q.reshape(-1, 4)[state].tolist()
+        bits = int(self.legal.reshape(-1)[state])
+        candidates = range(4)
+        if force_legal:
+            candidates = [i for i in candidates if bits & MazeCell.move_bits[i]]
+        # return a random selection if all q's are zero
+        if all(val == 0 for val in values):
+            return (rng or self.random).choice(candidates)
+        return max(candidates, key=values.__getitem__)
+
+    def update_state(self, state):
+        """
+        Update the q value of a state based on the Bellman equation and epsilon greedy.
+        Return the new state.  rl_train inlines this for speed.
+        """
+        hp = self.hp
+
+        # select a move based on epsilon greedy
+        if self.random.random() < hp.epsilon:
+            move = self.random.randrange(4) # explore
+        else:
+            move = self.best_move(state) # exploit
+
+        # update epsilon
+        hp.epsilon = max(hp.min_epsilon, hp.epsilon * hp.epsilon_decay)
+
+        # compute reward, don't apply an illegal move
+        if self.legal.reshape(-1)[state] & MazeCell.move_bits[move]:
+            new_state = state + self.offsets[move]
+            reward = hp.rGoal if new_state == self.goal_state else hp.rLegal
+        else:
+            new_state = state
+            reward = hp.rIllegal
+
+        # update q
+        self.q_version.reshape(-1)[state] = self.changed()
+        q = self.q.reshape(-1, 4)
+        current_q = float(q[state, move])
+        new_state_q = float(q[new_state].max())
+        q[state, move] = current_q + hp.alpha * (reward + (hp.gamma * new_state_q) - current_q)
+
+        return new_state
+
     # run training by starting multiple passes at random places
     # for each pass:
     #   update q values until the goal is reached
-    def rl_train(self, passes = 10):
-        "run training for the specified number of passes"
-        for _ in range(passes):
-        
-            cell = self.get_random_cell()
-            steps = 0
-
-            while (not cell.goal):
-                cell = cell.update_state()
-                steps += 1
+    @property
+    def read_only(self):
+        "True for a maze restored read only, which can't be trained"
+        return not self.q.flags.writeable
 
+    def rl_train(self, passes = 10, batch_size = 1, seed = None, max_episode_steps = None, max_steps = None,
+                 episodes = None):
+        """
+        Run training for the specified number of passes.
+        With batch_size > 1, batch_size agents are stepped together, see train_batch.
+        Otherwise hp.planning_steps > 0 adds simulated backups to each step, see train_planning.
+        A seed reseeds the random sources so training is reproducible.
+        A pass ends at the goal, or after max_episode_steps steps if given.
+        With max_steps, training stops once about that many steps have been taken and the episodes
+        still running are left in unfinished.  Passing them back as episodes, to a call with the same
+        batch_size, continues them as if training had not stopped, they count towards passes.
+        Return the number of environment steps taken, the steps in each finished pass are kept in episode_lengths.
+        """
+        if self.read_only:
+            raise ValueError('a read only maze can not be trained')
+        if seed is not None:
+            self.random.seed(seed)
+            self.np_random = np.random.default_rng(seed)
+        if episodes is None:
+            episodes = no_episodes()
+        if batch_size > 1:
+            steps = self.train_batch(passes, batch_size, max_episode_steps, max_steps, episodes)
+        elif self.hp.planning_steps > 0:
+            steps = self.train_planning(passes, max_episode_steps, max_steps, episodes)
+        else:
+            steps = self.train_sequential(passes, max_episode_steps, max_steps, episodes)
         # track the total number of passes
-        self.total_training_passes += passes
+        self.total_training_passes += len(self.episode_lengths)
+        return steps
+
+    def train_sequential(self, passes, max_episode_steps = None, max_steps = None, episodes = None):
+        "train one pass at a time, return the number of steps taken, see rl_train for max_steps and episodes"
+        hp = self.hp
+        epsilon = hp.epsilon
+        epsilon_decay = hp.epsilon_decay
+        min_epsilon = hp.min_epsilon
+        alpha = hp.alpha
+        gamma = hp.gamma
+        rIllegal = hp.rIllegal
+        rLegal = hp.rLegal
+        rGoal = hp.rGoal
+        goal = self.goal_state
+        offsets = self.offsets
+        bits = MazeCell.move_bits
+        # flat memoryviews give fast scalar access to the arrays
+        legal = memoryview(self.legal.reshape(-1))
+        q = memoryview(self.q.reshape(-1))
+        q_version = memoryview(self.q_version.reshape(-1))
+        version = self.version + 1 # of the q values changed, the maze only moves to it once a step is taken
+        rand = self.random.random
+        randrange = self.random.randrange
+        n_states = self.rows * self.cols
+        episode_limit = max_episode_steps if max_episode_steps else 1 << 62
+        step_limit = max_steps if max_steps else 1 << 62
+        steps = 0
+        lengths = array('q')
+        # continue an unfinished episode, -1 starts a new one
+        started = len(episodes[0]) if episodes is not None else 0
+        state = int(episodes[0][0]) if started else -1
+        taken = int(episodes[1][0]) if started else 0
+
+        while True:
+            if state < 0:
+                if started >= passes or steps >= step_limit:
+                    break
+                state = randrange(n_states)
+                taken = 0
+                started += 1
+            episode_start = steps - taken
+            episode_end = min(episode_start + episode_limit, step_limit)
+
+            while state != goal and steps < episode_end:
+                steps += 1
+                base = state * 4
+
+                # select a move based on epsilon greedy
+                if rand() < epsilon:
+                    move = randrange(4)
+                else:
+                    values = q[base:base + 4].tolist()
+                    best = max(values)
+                    if best == 0 and min(values) == 0:
+                        move = randrange(4) # all q values are 0
+                    else:
+                        move = values.index(best)
+                epsilon *= epsilon_decay
+                if epsilon < min_epsilon:
+                    epsilon = min_epsilon
+
+                # compute reward, don't apply an illegal move
+                if legal[state] & bits[move]:
+                    new_state = state + offsets[move]
+                    reward = rGoal if new_state == goal else rLegal
+                else:
+                    new_state = state
+                    reward = rIllegal
+
+                # update q
+                new_base = new_state * 4
+                new_state_q = max(q[new_base], q[new_base + 1], q[new_base + 2], q[new_base + 3])
+                current_q = q[base + move]
+                q[base + move] = current_q + alpha * (reward + (gamma * new_state_q) - current_q)
+                q_version[state] = version
+                state = new_state
+            if state != goal and steps - episode_start < episode_limit:
+                break # out of steps, the episode is unfinished
+            lengths.append(steps - episode_start)
+            state = -1
+
+        if steps:
+            self.changed()
+        hp.epsilon = epsilon
+        self.episode_lengths = np.frombuffer(lengths, dtype=np.int64)
+        self.unfinished = no_episodes() if state < 0 else (np.array([state], dtype=np.int64),
+                                                            np.array([steps - episode_start], dtype=np.int64))
+        return steps
+
+    def train_planning(self, passes, max_episode_steps = None, max_steps = None, episodes = None):
+        """
+        Train one pass at a time as train_sequential, adding hp.planning_steps simulated
+        backups per real step from the moves taken so far (Dyna-Q), see Planner.
+        The backups are made in rounds every PLANNING_INTERVAL real steps, and at the end.
+        Return the number of real steps taken, see rl_train for max_steps and episodes.
+        """
+        hp = self.hp
+        epsilon = hp.epsilon
+        epsilon_decay = hp.epsilon_decay
+        min_epsilon = hp.min_epsilon
+        alpha = hp.alpha
+        gamma = hp.gamma
+        rIllegal = hp.rIllegal
+        rLegal = hp.rLegal
+        rGoal = hp.rGoal
+        goal = self.goal_state
+        offsets = self.offsets
+        bits = MazeCell.move_bits
+        legal = memoryview(self.legal.reshape(-1))
+        q = memoryview(self.q.reshape(-1))
+        q_version = memoryview(self.q_version.reshape(-1))
+        observed = memoryview(self.observed.reshape(-1))
+        version = self.version + 1 # of the q values changed, the maze only moves to it once a step is taken
+        planner = Planner(self, version)
+        budget = PLANNING_INTERVAL * hp.planning_steps
+        rand = self.random.random
+        randrange = self.random.randrange
+        n_states = self.rows * self.cols
+        episode_limit = max_episode_steps if max_episode_steps else 1 << 62
+        step_limit = max_steps if max_steps else 1 << 62
+        steps = 0
+        lengths = array('q')
+        # continue an unfinished episode, -1 starts a new one
+        started = len(episodes[0]) if episodes is not None else 0
+        state = int(episodes[0][0]) if started else -1
+        taken = int(episodes[1][0]) if started else 0
+        # moves taken since the last planning round, and those among them new to the model
+        taken_pairs = array('q')
+        new_pairs = array('q')
+
+        while True:
+            if state < 0:
+                if started >= passes or steps >= step_limit:
+                    break
+                state = randrange(n_states)
+                taken = 0
+                started += 1
+            episode_start = steps - taken
+            episode_end = min(episode_start + episode_limit, step_limit)
+
+            while state != goal and steps < episode_end:
+                steps += 1
+                base = state * 4
+
+                # select a move based on epsilon greedy
+                if rand() < epsilon:
+                    move = randrange(4)
+                else:
+                    values = q[base:base + 4].tolist()
+                    best = max(values)
+                    if best == 0 and min(values) == 0:
+                        move = randrange(4) # all q values are 0
+                    else:
+                        move = values.index(best)
+                epsilon *= epsilon_decay
+                if epsilon < min_epsilon:
+                    epsilon = min_epsilon
+
+                # compute reward, don't apply an illegal move
+                if legal[state] & bits[move]:
+                    new_state = state + offsets[move]
+                    reward = rGoal if new_state == goal else rLegal
+                else:
+                    new_state = state
+                    reward = rIllegal
+
+                # update q
+                new_base = new_state * 4
+                new_state_q = max(q[new_base], q[new_base + 1], q[new_base + 2], q[new_base + 3])
+                current_q = q[base + move]
+                q[base + move] = current_q + alpha * (reward + (gamma * new_state_q) - current_q)
+                q_version[state] = version
+
+                # add the move to the model, and plan
+                taken_pairs.append(base + move)
+                if not observed[state] & bits[move]:
+                    observed[state] |= bits[move]
+                    new_pairs.append(base + move)
+                if len(taken_pairs) == PLANNING_INTERVAL:
+                    planner.plan(taken_pairs, new_pairs, budget)
+                    del taken_pairs[:], new_pairs[:]
+                state = new_state
+            if state != goal and steps - episode_start < episode_limit:
+                break # out of steps, the episode is unfinished
+            lengths.append(steps - episode_start)
+            state = -1
+        if taken_pairs:
+            planner.plan(taken_pairs, new_pairs, len(taken_pairs) * hp.planning_steps)
+
+        if steps:
+            self.changed()
+        hp.epsilon = epsilon
+        self.episode_lengths = np.frombuffer(lengths, dtype=np.int64)
+        self.unfinished = no_episodes() if state < 0 else (np.array([state], dtype=np.int64),
+                                                            np.array([steps - episode_start], dtype=np.int64))
+        return steps
+
+    def random_starts(self, rng, count):
+        "return an array of count random states, excluding the goal"
+        starts = rng.integers(0, self.rows * self.cols - 1, count)
+        starts[starts >= self.goal_state] += 1
+        return starts
+
+    def train_batch(self, passes, batch_size, max_episode_steps = None, max_steps = None, episodes = None):
+        """
+        Train batch_size agents at once with numpy operations over the batch.
+        Agents start at random cells and are restarted in place when they reach the goal
+        or have taken max_episode_steps steps, until passes episodes have started, then the
+        remaining agents finish their episodes.  When several agents update the same q value
+        in one step only one of the updates is kept.
+        Return the number of steps taken, see rl_train for max_steps and episodes.
+        """
+        hp = self.hp
+        self.unfinished = no_episodes()
+        if self.rows * self.cols == 1:
+            self.episode_lengths = np.zeros(passes, dtype=np.int64)
+            return 0 # every pass starts at the goal
+        rng = self.np_random
+        legal = self.legal.reshape(-1)
+        q = self.q.reshape(-1, 4)
+        q_version = self.q_version.reshape(-1)
+        version = self.version + 1 # of the q values changed, the maze only moves to it once a step is taken
+        offsets = np.array(self.offsets)
+        bits = np.array(MazeCell.move_bits, dtype=np.uint8)
+        epsilon = hp.epsilon
+
+        step_limit = max_steps if max_steps else 1 << 62
+        if episodes is not None and len(episodes[0]):
+            # continue unfinished episodes
+            states, agent_steps = episodes[0].copy(), episodes[1].copy()
+            started = len(states)
+        else:
+            started = min(batch_size, passes)
+            states = self.random_starts(rng, started)
+            agent_steps = np.zeros(started, dtype=np.int64)
+        lengths = [] # steps of the agents restarted at each step
+        steps = 0
+        while len(states) and steps < step_limit:
+            agents = len(states)
+            # select moves based on epsilon greedy, at random where all q values are 0
+            state_q = q[states]
+            moves = state_q.argmax(axis=1)
+            explore = (rng.random(agents) < epsilon) | ~state_q.any(axis=1)
+            moves[explore] = rng.integers(0, 4, int(explore.sum()))
+            # epsilon decays once per agent step, as in train_sequential
+            epsilon = max(hp.min_epsilon, epsilon * hp.epsilon_decay ** agents)
+
+            # compute rewards, don't apply illegal moves
+            ok = (legal[states] & bits[moves]) != 0
+            new_states = np.where(ok, states + offsets[moves], states)
+            at_goal = new_states == self.goal_state
+            rewards = np.where(ok, np.where(at_goal, hp.rGoal, hp.rLegal), hp.rIllegal)
+
+            # update q
+            current_q = state_q[np.arange(agents), moves]
+            new_state_q = q[new_states].max(axis=1)
+            q[states, moves] = current_q + hp.alpha * (rewards + (hp.gamma * new_state_q) - current_q)
+            q_version[states] = version
+            steps += agents
+
+            # restart agents which reached the goal or the step limit, drop them once passes have started
+            agent_steps += 1
+            ended = at_goal
+            if max_episode_steps:
+                ended = at_goal | (agent_steps >= max_episode_steps)
+            done = int(ended.sum())
+            if done:
+                ended = np.flatnonzero(ended)
+                restarted = min(done, passes - started)
+                lengths.append(agent_steps[ended])
+                agent_steps[ended] = 0
+                new_states[ended[:restarted]] = self.random_starts(rng, restarted)
+                started += restarted
+                if restarted < done:
+                    running = np.ones(agents, dtype=bool)
+                    running[ended[restarted:]] = False
+                    new_states = new_states[running]
+                    agent_steps = agent_steps[running]
+            states = new_states
+
+        if steps:
+            self.changed()
+        hp.epsilon = epsilon
+        self.episode_lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+        if len(states):
+            self.unfinished = (states, agent_steps)
+        return steps
 
     def solve_from(self, x = 0, y = 0, max_steps = 1000):
         """
-        Solve the maze using the learned policy by selecting the move with the maximum q value.
+        Solve the maze using the learned policy by selecting the legal move with the maximum q value.
         quit if max_steps is reached.
+        The path is cached until the q values change.
         """
+        if not (0 <= x < self.cols and 0 <= y < self.rows):
+            raise ValueError(f'start {x}, {y} is outside the maze')
+        key = ('solve_from', x, y, max_steps)
+        cached = self.cached_solution(key)
+        if cached is not None:
+            self.solve_path = cached
+            return
 
         # clear previous solutions
         self.solve_path = []
 
         steps = 0
-        cell = self.cell_matrix[y][x]
-        self.solve_path.append((cell.x, cell.y))
-        while ((not cell.goal) and (steps < max_steps)):
-            cell = cell.next_state(cell.best_move(True)) # only allows legal moves
-            self.solve_path.append((cell.x, cell.y))
+        state = self.state(x, y)
+        self.solve_path.append((x, y))
+        while ((state != self.goal_state) and (steps < max_steps)):
+            state += self.offsets[self.best_move(state, True, self.solve_random)] # only allows legal moves
+            self.solve_path.append(self.loc(state))
             steps += 1
+        self.cache_solution(key, self.solve_path, len(self.solve_path))
+
+    def cached_solution(self, key):
+        "return the cached solution for key and mark it recently used, None if there is none for this version"
+        if self.solve_cache_version != self.version:
+            # the q values changed, drop the solutions of older versions
+            self.solve_cache.clear()
+            self.solve_cache_bytes = 0
+            self.solve_cache_version = self.version
+            return None
+        cached = self.solve_cache.get(key)
+        if cached is None:
+            return None
+        self.solve_cache.move_to_end(key)
+        return cached[0]
+
+    def cache_solution(self, key, solution, length):
+        "keep a solution with length locations until the q values change, see SOLVE_CACHE_BYTES"
+        size = PATH_POINT_BYTES * length
+        self.solve_cache[key] = (solution, size)
+        self.solve_cache_bytes += size
+        while self.solve_cache_bytes > SOLVE_CACHE_BYTES and len(self.solve_cache) > 1:
+            _, (_, dropped) = self.solve_cache.popitem(last=False)
+            self.solve_cache_bytes -= dropped
+
+    def policy_map(self):
+        """
+        Return (successors, lengths) arrays for every state, see greedy_successors and greedy_path_lengths.
+        Cached until the q values change.
+        """
+        if self.policy_version != self.version:
+            successors = self.greedy_successors()
+            self.policy = (successors, self.greedy_path_lengths(successors))
+            self.policy_version = self.version
+        return self.policy
 
-    
-
-
-
-
-
-
-
+    def solve_batch(self, starts, max_steps = 1000):
+        """
+        Follow the greedy policy from each (x, y) in starts for at most max_steps steps.
+        Unlike solve_from, a path stops at a cell with no greedy move instead of moving at random.
+        Return a list of dictionaries with the start, solve_path, whether the goal was reached
+        and the full greedy path length (-1 if it never reaches the goal).
+        Paths are cached until the q values change.
+        """
+        successors, lengths = self.policy_map()
+        results = []
+        for x, y in starts:
+            key = ('solve_batch', x, y, max_steps)
+            solution = self.cached_solution(key)
+            if solution is None:
+                state = self.state(x, y)
+                path = [(x, y)]
+                for _ in range(max_steps):
+                    next_state = int(successors[state])
+                    if next_state == state:
+                        break # at the goal, or no greedy move
+                    state = next_state
+                    path.append(self.loc(state))
+                solution = {'start': (x, y),
+                            'solve_path': path,
+                            'reached': state == self.goal_state,
+                            'length': int(lengths[self.state(x, y)])}
+                self.cache_solution(key, solution, len(path))
+            results.append(solution)
+        return results
+
+    # convergence of the learned policy
+    # compared against exact shortest path distances to the goal
+    ###############################
 
-    
-        
+    def goal_distances(self):
+        "array of the shortest path length from each state to the goal, -1 if unreachable. Cached per maze."
+        if self.distances is None:
+            legal = self.legal.reshape(-1).tolist()
+            offsets = self.offsets
+            bits = MazeCell.move_bits
+            distances = [-1] * (self.rows * self.cols)
+            distances[self.goal_state] = 0
+            # breadth first search from the goal, the queue grows as it is walked
+            queue = [self.goal_state]
+            for state in queue:
+                distance = distances[state] + 1
+                for i in range(4):
+                    if legal[state] & bits[i]:
+                        next_state = state + offsets[i]
+                        if distances[next_state] < 0:
+                            distances[next_state] = distance
+                            queue.append(next_state)
+            self.distances = np.array(distances, dtype=np.int32)
+        return self.distances
+
+    def greedy_successors(self):
+        """
+        Array of the state each state moves to under the greedy policy of solve_from.
+        States with all q values 0 have no greedy move and map to themselves, the goal maps to itself.
+        """
+        q = self.q.reshape(-1, 4)
+        states = np.arange(len(q))
+        open_moves = (self.legal.reshape(-1, 1) & np.array(MazeCell.move_bits, dtype=np.uint8)) != 0
+        moves = np.where(open_moves, q, -np.inf).argmax(axis=1)
+        successors = states + np.array(self.offsets)[moves]
+        stuck = ~q.any(axis=1) | ~open_moves.any(axis=1)
+        successors[stuck] = states[stuck]
+        successors[self.goal_state] = self.goal_state
+        return successors
+
+    def greedy_path_lengths(self, successors = None):
+        """
+        Array of the length of the greedy path from each state to the goal, -1 if it never arrives.
+        Pointer jumping compresses every path at once, doubling the distance followed on every round,
+        so log2(states) rounds suffice.  Paths caught in a cycle or at a cell with no greedy move
+        never reach the goal.
+        """
+        if successors is None:
+            successors = self.greedy_successors()
+        lengths = (successors != np.arange(len(successors))).astype(np.int64)
+        for _ in range(max(1, int(len(successors) - 1).bit_length())):
+            lengths += lengths[successors]
+            successors = successors[successors]
+        return np.where(successors == self.goal_state, lengths, -1)
+
+    def convergence(self):
+        """
+        Dictionary describing how well the greedy policy solves the maze:
+        converged, the fraction of cells whose greedy path reaches the goal,
+        optimal, the fraction whose greedy path is a shortest path,
+        path_optimality, shortest over greedy path length summed over the cells that reach the goal.
+        """
+        distances = self.goal_distances()
+        _, lengths = self.policy_map()
+        cells = distances > 0 # reachable cells other than the goal
+        reached = cells & (lengths >= 0)
+        count = int(cells.sum())
+        if not count:
+            return {'converged': 1.0, 'optimal': 1.0, 'path_optimality': 1.0}
+        greedy_total = int(lengths[reached].sum())
+        return {'converged': int(reached.sum()) / count,
+                'optimal': int((cells & (lengths == distances)).sum()) / count,
+                'path_optimality': int(distances[reached].sum()) / greedy_total if greedy_total else 0.0}
+
+class Planner:
+    """
+    Simulated backups of the moves observed in a maze (the model), for Maze.train_planning.
+    Moves are deterministic, so a simulated backup sets a q value to its model target
+    reward + gamma * max q of the next cell, rather than moving alpha of the way.
+    Backups are made in numpy batches: a Dyna-Q round replays observed moves drawn at random,
+    with hp.prioritized_sweeping a round backs up the moves whose q values are furthest from
+    their targets and then the observed moves into every cell whose best q value changed,
+    so the reward spreads back from the goal one layer of cells per batch.
+    """
+
+    def __init__(self, maze, version):
+        hp = maze.hp
+        self.maze = maze
+        self.version = version # q_version of cells changed
+        self.sweeping = hp.prioritized_sweeping
+        self.threshold = hp.priority_threshold
+        self.gamma = hp.gamma
+        self.rewards = np.array([hp.rIllegal, hp.rLegal, hp.rGoal], dtype=Q_DTYPE)
+        self.legal = maze.legal.reshape(-1)
+        self.q = maze.q.reshape(-1)
+        self.cell_q = maze.q.reshape(-1, 4)
+        self.q_version = maze.q_version.reshape(-1)
+        self.observed = maze.observed.reshape(-1)
+        self.bits = np.array(MazeCell.move_bits, dtype=np.uint8)
+        self.offsets = np.array(maze.offsets, dtype=np.int64)
+        self.rng = maze.np_random
+        # observed moves as pair numbers (state * 4 + move), the first count are in use
+        moves = np.unpackbits(maze.observed.reshape(-1, 1), axis=1, bitorder='little')[:, :4]
+        self.pairs = np.flatnonzero(moves).astype(np.int64)
+        self.count = len(self.pairs)
+        # pairs to check for sweeping left over from the last round
+        self.candidates = np.zeros(0, dtype=np.int64)
+
+    def targets(self, pairs):
+        "model targets of the q values of pairs"
+        states = pairs >> 2
+        moves = pairs & 3
+        legal = (self.legal[states] & self.bits[moves]) != 0
+        new_states = np.where(legal, states + self.offsets[moves], states)
+        # rewards index 0 illegal, 1 legal and 2 reaching the goal
+        rewards = self.rewards[legal.astype(np.int64) + (new_states == self.maze.goal_state)]
+        return rewards + self.gamma * self.cell_q[new_states].max(axis=1)
+
+    def backup(self, pairs, targets):
+        "set the q values of pairs to targets"
+        self.q[pairs] = targets
+        self.q_version[pairs >> 2] = self.version
+
+    def predecessors(self, states):
+        "the observed moves into each of states, a legal move from a neighbor or an illegal move in place"
+        cells = np.repeat(states, 4)
+        moves = np.tile(np.arange(4), len(states))
+        legal = (self.legal[cells] & self.bits[moves]) != 0
+        # the reverse of a move is two further on in the move order
+        pairs = np.where(legal, (cells + self.offsets[moves]) * 4 + ((moves + 2) & 3), cells * 4 + moves)
+        return pairs[(self.observed[pairs >> 2] & self.bits[pairs & 3]) != 0]
+
+    def plan(self, taken, new, budget):
+        "make up to budget backups after the real moves taken, new lists those new to the model"
+        if not self.sweeping:
+            if new:
+                if self.count + len(new) > len(self.pairs):
+                    self.pairs = np.resize(self.pairs, max(2 * len(self.pairs), self.count + len(new)))
+                self.pairs[self.count:self.count + len(new)] = new
+                self.count += len(new)
+            pairs = self.pairs[self.rng.integers(0, self.count, budget)]
+            self.backup(pairs, self.targets(pairs))
+            return
+
+        # back up the furthest off pairs, then the pairs into cells whose best q value changed
+        pairs = np.unique(np.concatenate((self.candidates, np.frombuffer(taken, dtype=np.int64))))
+        left = []
+        while budget > 0 and len(pairs):
+            targets = self.targets(pairs)
+            errors = np.abs(targets - self.q[pairs])
+            off = errors > self.threshold
+            pairs, targets, errors = pairs[off], targets[off], errors[off]
+            if len(pairs) > budget:
+                order = np.argpartition(errors, len(pairs) - budget)
+                left.append(pairs[order[:len(pairs) - budget]])
+                pairs, targets = pairs[order[-budget:]], targets[order[-budget:]]
+            states = pairs >> 2
+            best = self.cell_q[states].max(axis=1)
+            self.backup(pairs, targets)
+            budget -= len(pairs)
+            pairs = self.predecessors(np.unique(states[self.cell_q[states].max(axis=1) != best]))
+        left.append(pairs)
+        self.candidates = np.unique(np.concatenate(left))
@@ -0,0 +1,179 @@
+import bisect
+import math
+import threading
+import numpy as np
+
+# defines Counter, Gauge, Histogram and MetricsRegistry classes
+#
+# A small implementation of Prometheus metrics, exposed in the Prometheus text
+# format by MetricsRegistry.expose.  Each metric is a family of values by label
+# values, labels are passed as keyword arguments, for example
+#   requests.inc(endpoint='/create', method='POST')
+# Modules create their metrics on the shared registry where they record them.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# histogram buckets, upper bounds
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = tuple(4 ** i for i in range(5, 16)) # 1KB to 1GB
+STEPS_BUCKETS = tuple(2 ** i for i in range(0, 21)) # 1 to about 1M
+
+def format_value(value):
+    "a sample value in the text format"
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def format_labels(labels):
+    "{name=\"value\",...} for a dictionary of labels, empty for none"
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+class Metric:
+    "a named family of values by label values, the base of the metric types"
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labels = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {} # tuple of label values to value
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        "tuple of label values from keyword arguments"
+        if len(labels) == len(self.labels):
+            try:
+                return tuple([labels[name] for name in self.labels])
+            except KeyError:
+                pass
+        raise ValueError(f'{self.name} has labels {self.labels}, not {tuple(labels)}')
+
+    def samples(self):
+        "list of (name, labels, value) to expose"
+        with self.lock:
+            return [(self.name, dict(zip(self.labels, key)), value) for key, value in sorted(self.values.items())]
+
+    def expose(self):
+        "the metric in the text format"
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines += [f'{name}{format_labels(labels)} {format_value(value)}' for name, labels, value in self.samples()]
+        return '\n'.join(lines) + '\n'
+
+class Counter(Metric):
+    "a total which only increases"
+    type = 'counter'
+
+    def inc(self, amount = 1, **labels):
+        "add amount to the counter"
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    "a value which can go up and down, or is read from a function when exposed"
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labels = (), function = None):
+        super().__init__(name, documentation, labels)
+        self.function = function # returns the value of an unlabelled gauge
+
+    def set(self, value, **labels):
+        "set the gauge to value"
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount = 1, **labels):
+        "add amount to the gauge, which may be negative"
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        if self.function:
+            return [(self.name, {}, self.function())]
+        return super().samples()
+
+class Histogram(Metric):
+    "counts of observed values in buckets by upper bound, with their sum and count"
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels = (), buckets = SECONDS_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.bounds = np.array(self.buckets) # for observe_many
+
+    def observe(self, value, **labels):
+        "count one value"
+        index = bisect.bisect_left(self.buckets, value)
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [np.zeros(len(self.buckets), dtype=np.int64), 0.0]
+            entry = self.values[key]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def observe_many(self, values, **labels):
+        "count a sequence or array of values"
+        values = np.asarray(values, dtype=np.float64).reshape(-1)
+        if not len(values):
+            return
+        counts = np.bincount(self.bounds.searchsorted(values), minlength=len(self.buckets))
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [np.zeros(len(self.buckets), dtype=np.int64), 0.0]
+            entry = self.values[key]
+            entry[0] += counts
+            entry[1] += float(values.sum())
+
+    def samples(self):
+        with self.lock:
+            values = [(key, counts.cumsum().tolist(), total) for key, (counts, total) in sorted(self.values.items())]
+        samples = []
+        for key, cumulative, total in values:
+            labels = dict(zip(self.labels, key))
+            samples += [(self.name + '_bucket', dict(labels, le=format_value(bound)), count)
+                        for bound, count in zip(self.buckets, cumulative)]
+            samples += [(self.name + '_sum', labels, total), (self.name + '_count', labels, cumulative[-1])]
+        return samples
+
+class MetricsRegistry:
+    "the metrics exposed together"
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        "add a metric, return it"
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f'metric {metric.name} is already registered')
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labels = ()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels = (), function = None):
+        return self.register(Gauge(name, documentation, labels, function))
+
+    def histogram(self, name, documentation, labels = (), buckets = SECONDS_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def expose(self):
+        "all metrics in the text format"
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return ''.join(metric.expose() for metric in metrics)
+
+# the registry exposed on /metrics
+registry = MetricsRegistry()
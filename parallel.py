@@ -0,0 +1,146 @@
+import contextlib
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+import numpy as np
+from maze import Maze, RLHyperP
+
+# defines ParallelTrainer, which trains one maze on a pool of processes
+#
+# Training runs in rounds of sync_passes passes split across the workers.
+# At the start of a round the merged q table is in shared memory, every
+# worker copies it into its own shared slot, trains the copy for its share of
+# the passes and reports the steps taken.  The parent then merges the slots,
+# averaging the change to each q value over the workers that changed it, and
+# adds the averaged changes to the maze.  The moves observed for planning, see
+# Maze.train_planning, go the same way: every worker starts a round from the
+# maze's observed moves and the parent adds the moves the workers observed.
+# The maze lock is only needed for the copy at the start of a round and the
+# merge, not while the workers train.  Walls are shared read only for the life
+# of the pool.
+# Worker seeds come from one SeedSequence, so the merged table is reproducible
+# for a given seed, worker count and sync interval.
+
+# per process state of a worker, set by init_worker
+worker = {}
+
+def init_worker(rows, cols, goal_state, legal_name, base_name, slots_name, observed_name, observed_slots_name):
+    "attach a worker process to the shared arrays"
+    blocks = [shared_memory.SharedMemory(name)
+              for name in (legal_name, base_name, slots_name, observed_name, observed_slots_name)]
+    maze = Maze({'rows': rows, 'cols': cols})
+    maze.goal_state = goal_state
+    maze.legal = np.ndarray((rows, cols), dtype=np.uint8, buffer=blocks[0].buf)
+    maze.q = np.ndarray(maze.q.shape, dtype=maze.q.dtype, buffer=blocks[1].buf)
+    worker['maze'] = maze
+    worker['base'] = maze.q
+    worker['slots'] = blocks[2]
+    worker['observed'] = np.ndarray((rows, cols), dtype=np.uint8, buffer=blocks[3].buf)
+    worker['observed_slots'] = blocks[4]
+    worker['blocks'] = blocks # keep the mappings open
+
+def train_share(slot, passes, batch_size, max_episode_steps, seed, hp):
+    "train a copy of the merged q table in a slot, return the steps taken, final epsilon and episode lengths"
+    maze = worker['maze']
+    base = worker['base']
+    maze.hp = RLHyperP(**hp)
+    maze.q = np.ndarray(base.shape, dtype=base.dtype, buffer=worker['slots'].buf, offset=slot * base.nbytes)
+    maze.q[:] = base
+    observed = worker['observed']
+    maze.observed = np.ndarray(observed.shape, dtype=np.uint8, buffer=worker['observed_slots'].buf,
+                               offset=slot * observed.nbytes)
+    maze.observed[:] = observed
+    steps = maze.rl_train(passes, batch_size, seed, max_episode_steps)
+    return steps, maze.hp.epsilon, maze.episode_lengths
+
+class ParallelTrainer:
+    """
+    Train a maze on a pool of worker processes, merging their q tables every sync_passes passes.
+    Use as a context manager, or call close when done.
+    """
+
+    def __init__(self, maze, workers = None, sync_passes = 100, seed = None):
+        if sync_passes < 1:
+            raise ValueError('sync_passes must be at least 1')
+        self.maze = maze
+        self.workers = workers if workers else os.cpu_count()
+        self.sync_passes = sync_passes # passes per round, across all workers
+        self.episode_lengths = np.zeros(0, dtype=np.int64) # steps in each pass of the last train
+        self.seeds = np.random.SeedSequence(seed)
+
+        # shared copies of the walls, the merged q table and one q table per worker,
+        # then the merged observed moves and the observed moves of each worker
+        q = maze.q
+        observed = maze.observed
+        self.blocks = [shared_memory.SharedMemory(create=True, size=size)
+                       for size in (maze.legal.nbytes, q.nbytes, q.nbytes * self.workers,
+                                    observed.nbytes, observed.nbytes * self.workers)]
+        np.ndarray(maze.legal.shape, dtype=np.uint8, buffer=self.blocks[0].buf)[:] = maze.legal
+        self.base = np.ndarray(q.shape, dtype=q.dtype, buffer=self.blocks[1].buf)
+        self.slots = np.ndarray((self.workers,) + q.shape, dtype=q.dtype, buffer=self.blocks[2].buf)
+        self.observed = np.ndarray(observed.shape, dtype=np.uint8, buffer=self.blocks[3].buf)
+        self.observed_slots = np.ndarray((self.workers,) + observed.shape, dtype=np.uint8, buffer=self.blocks[4].buf)
+        # spawn rather than fork, the server process runs threads
+        self.pool = multiprocessing.get_context('spawn').Pool(self.workers, init_worker,
+                                                              (maze.rows, maze.cols, maze.goal_state,
+                                                               *[block.name for block in self.blocks]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        "stop the workers and release the shared memory"
+        self.pool.terminate()
+        self.pool.join()
+        self.base = self.slots = self.observed = self.observed_slots = None
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def train(self, passes, batch_size = 1, max_episode_steps = None, lock = None):
+        """
+        Train the maze for passes in rounds of sync_passes, updating maze.q, maze.observed, maze.hp.epsilon
+        and maze.episode_lengths.
+        batch_size and max_episode_steps are as for Maze.rl_train.  lock, guarding the maze, is held
+        only while the q table is copied for a round and while the round is merged back.
+        Return the number of steps taken.
+        """
+        maze = self.maze
+        lock = lock if lock else contextlib.nullcontext()
+        steps = 0
+        lengths = []
+        done = 0
+        while done < passes:
+            round_passes = min(self.sync_passes, passes - done)
+            shares = [round_passes // self.workers + (i < round_passes % self.workers) for i in range(self.workers)]
+            seeds = [int(child.generate_state(1)[0]) for child in self.seeds.spawn(self.workers)]
+            with lock:
+                self.base[:] = maze.q
+                self.observed[:] = maze.observed
+                hp = dict(maze.hp.__dict__)
+            results = self.pool.starmap(train_share, [(i, shares[i], batch_size, max_episode_steps, seeds[i], hp)
+                                                      for i in range(self.workers) if shares[i]])
+            # average each q value change over the workers that changed it
+            trained = [i for i in range(self.workers) if shares[i]]
+            deltas = self.slots[trained] - self.base
+            changed = np.count_nonzero(deltas, axis=0)
+            delta = deltas.sum(axis=0) / np.maximum(changed, 1)
+            with lock:
+                maze.q += delta
+                cells = changed.any(axis=-1)
+                if cells.any():
+                    maze.q_version[cells] = maze.changed()
+                maze.observed |= np.bitwise_or.reduce(self.observed_slots[trained], axis=0)
+                maze.hp.epsilon = sum(epsilon for _, epsilon, _ in results) / len(results)
+                maze.total_training_passes += round_passes
+            steps += sum(share_steps for share_steps, _, _ in results)
+            lengths += [share_lengths for _, _, share_lengths in results]
+            done += round_passes
+        self.episode_lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+        with lock:
+            maze.episode_lengths = self.episode_lengths
+        return steps
@@ -0,0 +1,83 @@
+import sys
+import threading
+import time
+from collections import Counter
+
+# defines SamplingProfiler, which profiles one thread by sampling its stack
+#
+# A background thread reads the stack of the profiled thread from
+# sys._current_frames every interval seconds and counts each distinct stack.
+# Nothing is installed in the profiled thread, so it runs at full speed apart
+# from the time the sampler holds the GIL.  The counts give the hot paths:
+# functions by the samples they were running in (self) or on the stack
+# under (total), and collapsed stacks for flame graph tools.
+
+class SamplingProfiler:
+    "sample the stack of a thread every interval seconds while running"
+
+    def __init__(self, interval = 0.005, max_depth = 64):
+        self.thread_id = None
+        self.interval = interval
+        self.max_depth = max_depth # frames kept from the innermost
+        self.stacks = Counter() # tuple of frames, outermost first, to samples
+        self.samples = 0
+        self.started = None
+        self.stopped = None
+        self.stop_requested = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self, thread_id = None):
+        "start sampling a thread, by default the calling thread"
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.started = time.time()
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        "stop sampling and wait for the sampler to finish"
+        self.stop_requested.set()
+        if self.thread:
+            self.thread.join()
+        self.stopped = time.time()
+
+    def run(self):
+        "take samples until stopped or the thread ends"
+        while not self.stop_requested.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({code.co_filename.rsplit("/", 1)[-1]}:{code.co_firstlineno})')
+                frame = frame.f_back
+            with self.lock:
+                self.stacks[tuple(reversed(stack))] += 1
+                self.samples += 1
+
+    def collapsed(self):
+        "stacks in the collapsed format of flame graph tools, one 'outer;...;inner count' line per stack"
+        with self.lock:
+            stacks = self.stacks.most_common()
+        return ''.join(f'{";".join(stack)} {count}\n' for stack, count in stacks)
+
+    def report(self, limit = 30):
+        "dictionary of the profile for json, the limit hottest functions and stacks"
+        with self.lock:
+            stacks = self.stacks.most_common()
+            samples = self.samples
+        own = Counter()
+        total = Counter()
+        for stack, count in stacks:
+            own[stack[-1]] += count
+            for function in set(stack):
+                total[function] += count
+        return {'samples': samples,
+                'interval': self.interval,
+                'running': self.started is not None and self.stopped is None,
+                'seconds': (self.stopped or time.time()) - self.started if self.started else 0,
+                'functions': [{'function': function, 'self': count, 'total': total[function]}
+                              for function, count in own.most_common(limit)],
+                'cumulative': [{'function': function, 'total': count} for function, count in total.most_common(limit)],
+                'stacks': [{'stack': list(stack), 'samples': count} for stack, count in stacks[:limit]]}
@@ -0,0 +1,136 @@
+import threading
+import uuid
+from collections import OrderedDict
+
+# defines MazeEntry, MazeRegistry, OverBudget and Pinned classes
+#
+# The registry holds the mazes of all clients by id.  It tracks the approximate
+# memory used by each maze and evicts the least recently used mazes when the
+# total goes over the memory budget.  A maze larger than the whole budget is
+# refused rather than evicting everything else.  A maze being trained is
+# pinned by its job and never evicted or replaced, see pin.  Sizes grow as distances,
+# policy maps and solutions are cached, resize records the new size.
+# Each maze has its own lock so work on one maze never waits for work on
+# another, the registry lock only guards the table.
+
+class OverBudget(Exception):
+    "a maze is larger than the memory budget of the registry"
+
+class Pinned(Exception):
+    "a maze can't be replaced while a job trains it"
+
+class MazeEntry:
+    "a maze held in the registry, with its lock and approximate size in bytes"
+
+    def __init__(self, maze_id, maze):
+        self.id = maze_id
+        self.maze = maze
+        self.lock = threading.RLock()
+        self.size = maze.nbytes()
+        self.jobs = 0 # running training jobs, a pinned maze isn't evicted
+        self.removed = False # set once removed or replaced, but not when evicted
+
+class MazeRegistry:
+    "mazes by id, with a total memory budget and least recently used eviction"
+
+    def __init__(self, memory_budget = 1 << 30):
+        self.memory_budget = memory_budget # bytes
+        self.entries = OrderedDict() # least recently used first
+        self.total_size = 0
+        self.lock = threading.Lock()
+
+    def add(self, maze, maze_id = None):
+        """
+        Add a maze under a new id, or replace the maze with maze_id, evicting old mazes if needed.
+        Raise OverBudget for a maze larger than the memory budget, Pinned when replacing a maze being trained.
+        """
+        entry = MazeEntry(maze_id if maze_id else uuid.uuid4().hex, maze)
+        if not self.fits(entry.size):
+            raise OverBudget(f'maze of {entry.size} bytes is over the memory budget of {self.memory_budget} bytes')
+        with self.lock:
+            old = self.entries.get(entry.id)
+            if old and old.jobs:
+                raise Pinned(f'maze {entry.id} is being trained')
+            if old:
+                del self.entries[entry.id]
+                self.total_size -= old.size
+                old.removed = True
+            self.entries[entry.id] = entry
+            self.total_size += entry.size
+            self.evict()
+        return entry
+
+    def fits(self, size):
+        "True if a maze of size bytes fits in the memory budget"
+        return size <= self.memory_budget
+
+    def resize(self, entry):
+        "record the current size of an entry's maze, evicting old mazes if it grew"
+        size = entry.maze.nbytes()
+        with self.lock:
+            held = self.entries.get(entry.id) is entry
+            if held:
+                self.total_size += size - entry.size
+            entry.size = size
+            if held:
+                self.evict()
+
+    def pin(self, maze_id):
+        "keep a maze from eviction while a job trains it, return its entry or None if unknown"
+        with self.lock:
+            entry = self.entries.get(maze_id)
+            if entry:
+                entry.jobs += 1
+                self.entries.move_to_end(maze_id)
+            return entry
+
+    def unpin(self, entry):
+        "release a pin taken by pin, evicting if the registry went over budget meanwhile"
+        with self.lock:
+            entry.jobs -= 1
+            self.evict()
+
+    def holds(self, entry):
+        "True while an entry is in the registry, not removed or replaced"
+        with self.lock:
+            return self.entries.get(entry.id) is entry
+
+    def has(self, maze_id):
+        "True if a maze id is held, without marking it as recently used"
+        with self.lock:
+            return maze_id in self.entries
+
+    def get(self, maze_id):
+        "return the entry for a maze id and mark it as recently used, None if unknown"
+        with self.lock:
+            entry = self.entries.get(maze_id)
+            if entry:
+                self.entries.move_to_end(maze_id)
+            return entry
+
+    def all(self):
+        "list of all entries, least recently used first"
+        with self.lock:
+            return list(self.entries.values())
+
+    def remove(self, maze_id):
+        "remove a maze, return its entry or None if unknown"
+        with self.lock:
+            entry = self.entries.pop(maze_id, None)
+            if entry:
+                self.total_size -= entry.size
+                entry.removed = True
+            return entry
+
+    def evict(self):
+        "drop least recently used mazes until within budget, keeping the newest and pinned mazes. Hold self.lock."
+        if self.total_size <= self.memory_budget:
+            return
+        newest = next(reversed(self.entries))
+        for maze_id, entry in list(self.entries.items()):
+            if self.total_size <= self.memory_budget:
+                break
+            if not entry.jobs and maze_id != newest:
+                del self.entries[maze_id]
+                self.total_size -= entry.size
+
@@ -0,0 +1,213 @@
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import numpy as np
+from maze import Maze, RLHyperP
+
+# save and restore mazes as snapshot files which can be memory mapped
+#
+# file layout:
+#   8 byte magic, 8 byte little endian header length, json header
+#   arrays as raw little endian bytes, each starting on a 64 byte boundary
+# The header holds the maze fields and the dtype, shape and offset of each
+# array.  Restoring maps the arrays straight from the file, so a large trained
+# maze is ready in milliseconds and processes restoring the same snapshot share
+# its pages until they write to them.
+
+MAGIC = b'RLMAZE\x00\x01'
+ALIGN = 64
+SUFFIX = '.rlmaze'
+ARRAYS = ('legal', 'q', 'q_version', 'observed', 'path_cells', 'path_starts')
+
+logger = logging.getLogger(__name__)
+
+def snapshot_state(maze):
+    "header and copies of the arrays of a maze, so they can be written without holding the maze lock"
+    header = {'rows': maze.rows,
+              'cols': maze.cols,
+              'hp': maze.hp.__dict__.copy(),
+              'goal_state': maze.goal_state,
+              'version': maze.version,
+              'total_training_passes': maze.total_training_passes,
+              'generated': maze.generated}
+    arrays = {name: np.array(getattr(maze, name)) for name in ARRAYS}
+    return header, arrays
+
+def write_snapshot(path, header, arrays):
+    "write a snapshot file, replacing any earlier one at path only once it is complete"
+    header = dict(header, arrays={})
+    offset = 0
+    for name, values in arrays.items():
+        header['arrays'][name] = {'dtype': values.dtype.newbyteorder('<').str,
+                                  'shape': values.shape,
+                                  'offset': offset}
+        offset += -(-values.nbytes // ALIGN) * ALIGN
+    text = json.dumps(header).encode()
+    start = -(-(len(MAGIC) + 8 + len(text)) // ALIGN) * ALIGN # first array, offsets are relative to it
+    text = text.ljust(start - len(MAGIC) - 8)
+
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(text)) + text)
+        for name, values in arrays.items():
+            f.seek(start + header['arrays'][name]['offset'])
+            f.write(values.astype(header['arrays'][name]['dtype'], copy=False).tobytes())
+        f.truncate(start + offset)
+    os.replace(temp_path, path)
+
+def save_snapshot(maze, path):
+    "write a snapshot of a maze to path"
+    write_snapshot(path, *snapshot_state(maze))
+
+def load_snapshot(path, read_only = False):
+    """
+    Restore a maze from a snapshot, with its arrays memory mapped from the file.
+    The maps are copy on write, so the maze can be trained without changing the file.
+    With read_only the arrays can't be written, for processes that only solve.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a maze snapshot')
+        length = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(length))
+    start = len(MAGIC) + 8 + length
+
+    maze = Maze({'rows': header['rows'], 'cols': header['cols']}, RLHyperP(**header['hp']))
+    maze.goal_state = header['goal_state']
+    maze.version = header['version']
+    maze.total_training_passes = header['total_training_passes']
+    maze.generated = header['generated']
+    for name, spec in header['arrays'].items():
+        shape = tuple(spec['shape'])
+        if not np.prod(shape):
+            values = np.zeros(shape, dtype=spec['dtype']) # can't map an empty array
+        else:
+            values = np.memmap(path, dtype=spec['dtype'], mode='r' if read_only else 'c',
+                               offset=start + spec['offset'], shape=shape)
+        setattr(maze, name, values)
+    return maze
+
+class Checkpointer:
+    """
+    A thread which snapshots every maze in a registry that has changed, every interval seconds.
+    Beyond disk_budget bytes of snapshots, the least recently written snapshots of mazes
+    that aren't in memory are deleted.
+    """
+
+    def __init__(self, registry, directory, interval = 300, disk_budget = None):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self.disk_budget = disk_budget # bytes, None for no limit
+        self.saved = {} # maze id to the (epoch, version) last saved or restored
+        self.thread = None
+        self.lock = threading.Lock()
+        self.restoring = threading.RLock() # held while a maze is restored, so it is only restored once
+        # held while snapshot files are written or deleted, so a save can't bring back a deleted maze
+        self.writing = threading.Lock()
+
+    def path(self, maze_id):
+        "snapshot file for a maze id"
+        return os.path.join(self.directory, maze_id + SUFFIX)
+
+    def save(self, entry):
+        """
+        Snapshot a registry entry now, copying under the maze lock and writing without it.
+        Return the header written, None if the maze was removed or replaced.
+        """
+        with entry.lock:
+            state = snapshot_state(entry.maze)
+            epoch = entry.maze.epoch
+        with self.writing:
+            if entry.removed:
+                return None
+            os.makedirs(self.directory, exist_ok=True)
+            write_snapshot(self.path(entry.id), *state)
+            self.saved[entry.id] = (epoch, state[0]['version'])
+            self.prune(entry.id)
+        return state[0]
+
+    def prune(self, keep):
+        """
+        Delete the least recently written snapshots of mazes not in memory until within the disk budget,
+        never the snapshot of maze id keep.  Hold self.writing.
+        """
+        if self.disk_budget is None:
+            return
+        snapshots = sorted(self.snapshots(), key=lambda snapshot: snapshot['modified'])
+        total = sum(snapshot['size'] for snapshot in snapshots)
+        for snapshot in snapshots:
+            if total <= self.disk_budget:
+                break
+            if snapshot['id'] != keep and not self.registry.has(snapshot['id']):
+                self.delete(snapshot['id'])
+                total -= snapshot['size']
+                logger.info('deleted snapshot of maze %s, over the disk budget', snapshot['id'])
+
+    def get(self, maze_id):
+        "return the registry entry for a maze id, restoring it from its snapshot if it isn't held, None if neither"
+        entry = self.registry.get(maze_id)
+        if entry:
+            return entry
+        with self.restoring:
+            # another request may have restored it while this one waited
+            return self.registry.get(maze_id) or self.restore(maze_id)
+
+    def restore(self, maze_id, read_only = False):
+        """
+        Add the maze in a snapshot to the registry under its id, return the entry or None if there is no snapshot.
+        Raise registry.Pinned if the maze in memory is being trained.
+        """
+        with self.restoring, self.writing:
+            path = self.path(maze_id)
+            if not os.path.exists(path):
+                return None
+            maze = load_snapshot(path, read_only)
+            entry = self.registry.add(maze, maze_id)
+            self.saved[maze_id] = (maze.epoch, maze.version)
+            return entry
+
+    def remove(self, maze_id):
+        "delete the snapshot of a maze, return True if there was one"
+        with self.writing:
+            return self.delete(maze_id)
+
+    def delete(self, maze_id):
+        "delete the snapshot file of a maze, return True if there was one.  Hold self.writing."
+        self.saved.pop(maze_id, None)
+        try:
+            os.remove(self.path(maze_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def snapshots(self):
+        "list of dictionaries describing the snapshot files"
+        if not os.path.isdir(self.directory):
+            return []
+        return [{'id': name[:-len(SUFFIX)],
+                 'size': os.path.getsize(os.path.join(self.directory, name)),
+                 'modified': os.path.getmtime(os.path.join(self.directory, name))}
+                for name in sorted(os.listdir(self.directory)) if name.endswith(SUFFIX)]
+
+    def start(self):
+        "start the checkpoint thread if it isn't running and an interval is set"
+        with self.lock:
+            if self.interval and not self.thread:
+                self.thread = threading.Thread(target=self.run, name='checkpoint', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        "save changed mazes every interval seconds"
+        while True:
+            time.sleep(self.interval)
+            for entry in self.registry.all():
+                if self.saved.get(entry.id) != (entry.maze.epoch, entry.maze.version):
+                    try:
+                        self.save(entry)
+                    except Exception:
+                        # keep checkpointing the other mazes, and this one next time
+                        logger.exception('checkpoint of maze %s failed', entry.id)
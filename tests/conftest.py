@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# the modules live at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# keep the app from writing snapshots into the working directory
+os.environ.setdefault('SNAPSHOT_DIR', tempfile.mkdtemp(prefix='maze-test-'))
+os.environ.setdefault('CHECKPOINT_INTERVAL', '0')
@@ -0,0 +1,195 @@
+import os
+import threading
+import time
+import pytest
+from app import app
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+@pytest.fixture
+def maze_id(client):
+    response = client.post('/create', json={'rows': 10, 'cols': 12, 'seed': 1})
+    assert response.status_code == 201
+    yield response.json['id']
+    client.delete(f'/maze/{response.json["id"]}')
+
+@pytest.mark.parametrize('x, y', [(100, 0), (-1, 0), (0, 10), (12, 9), ('0', 0), (1.5, 0)])
+def test_solve_rejects_starts_outside_maze(client, maze_id, x, y):
+    response = client.post(f'/solve/{maze_id}', json={'x': x, 'y': y, 'max_steps': 10})
+    assert response.status_code == 400
+
+def test_solve_from_corner(client, maze_id):
+    response = client.post(f'/solve/{maze_id}', json={'x': 11, 'y': 9, 'max_steps': 10})
+    assert response.status_code == 200
+    assert response.json['solve_path'] == [[11, 9]]
+
+def train(client, maze_id, **options):
+    "run a training job to the end, return its status"
+    response = client.post(f'/train/{maze_id}', json=options)
+    assert response.status_code == 202
+    job = response.json
+    while job['state'] in ('queued', 'running'):
+        time.sleep(0.01)
+        job = client.get(f'/jobs/{job["id"]}').json
+    return job
+
+@pytest.mark.parametrize('batch_size', [1, 16])
+def test_seeded_training_jobs_are_reproducible(client, batch_size):
+    q = []
+    for _ in range(2):
+        maze_id = client.post('/create', json={'rows': 40, 'cols': 40, 'seed': 1}).json['id']
+        job = train(client, maze_id, passes=300, batch_size=batch_size, seed=5, max_episode_steps=1000)
+        assert job['state'] == 'done' and job['passes_done'] == 300
+        q.append(client.get(f'/maze/{maze_id}?format=compact').json['q'])
+        client.delete(f'/maze/{maze_id}')
+    assert q[0] == q[1]
+
+def test_create_over_budget(client, monkeypatch):
+    import app as server
+    monkeypatch.setattr(server.mazes, 'memory_budget', 100000)
+    response = client.post('/create', json={'rows': 100, 'cols': 100})
+    assert response.status_code == 413
+    assert client.post('/create', json={'rows': 0, 'cols': 10}).status_code == 400
+
+@pytest.mark.parametrize('seed', [[1], '1', 1.5, True])
+def test_create_rejects_bad_seed(client, seed):
+    assert client.post('/create', json={'rows': 5, 'cols': 5, 'seed': seed}).status_code == 400
+
+def test_job_stops_when_maze_deleted(client):
+    maze_id = client.post('/create', json={'rows': 100, 'cols': 100, 'seed': 1}).json['id']
+    job = client.post(f'/train/{maze_id}', json={'passes': 100000}).json
+    assert job['maze_id'] == maze_id
+    while job['state'] == 'queued':
+        time.sleep(0.001)
+        job = client.get(f'/jobs/{job["id"]}').json
+    assert client.delete(f'/maze/{maze_id}').status_code == 204
+    while job['state'] in ('queued', 'running'):
+        time.sleep(0.01)
+        job = client.get(f'/jobs/{job["id"]}').json
+    assert job['state'] == 'cancelled' and 'deleted' in job['error']
+    assert job['passes_done'] < 100000
+
+@pytest.mark.parametrize('options', [{'workers': 0}, {'workers': os.cpu_count() + 1}, {'sync_passes': 0},
+                                     {'batch_size': 0}, {'passes': -1}, {'passes': '10'},
+                                     {'planning_steps': 'x'}, {'planning_steps': -1}, {'prioritized_sweeping': 1},
+                                     {'priority_threshold': -1e-3}, {'priority_threshold': '0'},
+                                     {'max_episode_steps': -5}, {'max_episode_steps': 0}, {'max_episode_steps': '5'},
+                                     {'until_converged': 'a'}, {'until_converged': 0}, {'until_converged': 1.5},
+                                     {'seed': 'abc'}, {'seed': [1]}, {'seed': 1.5}])
+def test_train_rejects_bad_options(client, maze_id, options):
+    response = client.post(f'/train/{maze_id}', json=dict({'passes': 10}, **options))
+    assert response.status_code == 400
+    # the maze's hyperparameters are left as they were
+    hp = client.get(f'/maze/{maze_id}').json['cell_matrix'][0][0]['hp']
+    assert hp['planning_steps'] == 0 and hp['prioritized_sweeping'] is False
+
+@pytest.mark.parametrize('starts', [[[0, 0, 1]], [[0]], [0, 0], [[12, 0]], [[0, -1]], 'x', None])
+def test_solve_batch_rejects_bad_starts(client, maze_id, starts):
+    response = client.post(f'/solve/{maze_id}/batch', json={'starts': starts, 'max_steps': 10})
+    assert response.status_code == 400
+
+def test_restore_starts_new_epoch(client, maze_id):
+    assert client.post(f'/snapshot/{maze_id}').status_code == 201
+    train(client, maze_id, passes=20, seed=1)
+    trained = client.get(f'/maze/{maze_id}?format=compact')
+    restored = client.post(f'/restore/{maze_id}').json
+    assert restored['epoch'] != trained.json['epoch']
+    assert restored['version'] < trained.json['version']
+
+    # the old ETag doesn't match, and deltas from the old epoch or a later version get the whole maze
+    response = client.get(f'/maze/{maze_id}?format=compact', headers={'If-None-Match': trained.headers['ETag']})
+    assert response.status_code == 200
+    for query in (f'since={trained.json["version"]}',
+                  f'since=0&epoch={trained.json["epoch"]}'):
+        response = client.get(f'/maze/{maze_id}?format=compact&{query}')
+        assert response.json['format'] == 'compact'
+    response = client.get(f'/maze/{maze_id}?format=compact&since=0&epoch={restored["epoch"]}')
+    assert response.json['format'] == 'delta'
+
+def test_read_only_maze_not_trained(client, maze_id):
+    client.post(f'/snapshot/{maze_id}')
+    client.post(f'/restore/{maze_id}', json={'read_only': True})
+    version = client.get(f'/maze/{maze_id}?format=compact').json['version']
+    assert client.post(f'/train/{maze_id}', json={'passes': 10}).status_code == 409
+    assert client.get(f'/maze/{maze_id}?format=compact').json['version'] == version
+    assert client.post(f'/solve/{maze_id}', json={'x': 0, 'y': 0, 'max_steps': 10}).status_code == 200
+
+def test_restore_refused_while_training(client):
+    maze_id = client.post('/create', json={'rows': 100, 'cols': 100, 'seed': 1}).json['id']
+    client.post(f'/snapshot/{maze_id}')
+    job = client.post(f'/train/{maze_id}', json={'passes': 100000}).json
+    while job['state'] == 'queued':
+        time.sleep(0.001)
+        job = client.get(f'/jobs/{job["id"]}').json
+    assert client.post(f'/restore/{maze_id}').status_code == 409
+    client.delete(f'/jobs/{job["id"]}')
+    client.delete(f'/maze/{maze_id}')
+
+def test_missing_maze_restored_once(client, maze_id):
+    import app as server
+    client.post(f'/snapshot/{maze_id}')
+    server.mazes.remove(maze_id)
+    entries = []
+    threads = [threading.Thread(target=lambda: entries.append(server.checkpoints.get(maze_id))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(entries) == 8 and all(entry is entries[0] for entry in entries)
+
+def test_job_failing_before_training_unpins_maze(client, maze_id):
+    import app as server
+    entry = server.mazes.get(maze_id)
+    entry.maze.hp.planning_steps = None # fails while the job sets up its chunks
+    job = train(client, maze_id, passes=10, profile=True)
+    assert job['state'] == 'failed' and job['error']
+    assert entry.jobs == 0
+
+def test_job_profile(client):
+    maze_id = client.post('/create', json={'rows': 40, 'cols': 40, 'seed': 1}).json['id']
+    job = train(client, maze_id, passes=100, seed=1, max_episode_steps=1000, profile=True)
+    report = client.get(f'/jobs/{job["id"]}/profile').json
+    assert report['samples'] > 0 and not report['running']
+    assert report['functions'] and report['stacks']
+    assert sum(stack['samples'] for stack in report['stacks']) <= report['samples']
+    collapsed = client.get(f'/jobs/{job["id"]}/profile?format=collapsed').get_data(as_text=True)
+    assert sum(int(line.rsplit(' ', 1)[1]) for line in collapsed.splitlines()) == report['samples']
+    job = train(client, maze_id, passes=1)
+    assert client.get(f'/jobs/{job["id"]}/profile').status_code == 404
+    client.delete(f'/maze/{maze_id}')
+
+@pytest.mark.parametrize('q_dtype', ['float16', 'float32', 'float64'])
+def test_compact_and_delta_payloads(client, q_dtype):
+    import base64
+    import numpy as np
+    import app as server
+    maze_id = client.post('/create', json={'rows': 5, 'cols': 7, 'seed': 1}).json['id']
+    maze = server.mazes.get(maze_id).maze
+    url = f'/maze/{maze_id}?format=compact&q_dtype={q_dtype}'
+    before = client.get(url).json
+    train(client, maze_id, passes=20, seed=1)
+
+    def decode(text, dtype):
+        return np.frombuffer(base64.b64decode(text), dtype=np.dtype(dtype).newbyteorder('<'))
+    response = client.get(url)
+    compact = response.json
+    packed = decode(compact['legal'], np.uint8)
+    legal = np.stack([packed & 15, packed >> 4], axis=1).reshape(-1)[:35] # two cells per byte, low bits first
+    assert np.array_equal(legal, maze.legal.reshape(-1))
+    assert np.array_equal(decode(compact['q'], q_dtype).reshape(5, 7, 4), maze.q.astype(q_dtype))
+
+    delta = client.get(f'{url}&since={before["version"]}&epoch={before["epoch"]}').json
+    assert delta['format'] == 'delta'
+    cells = decode(delta['cells'], np.int32)
+    assert len(cells) and (maze.q_version.reshape(-1)[cells] > before['version']).all()
+    assert np.array_equal(decode(delta['q'], q_dtype).reshape(-1, 4), maze.q.reshape(-1, 4)[cells].astype(q_dtype))
+
+    # 304 while nothing changed, but not once the hyperparameters change
+    etag = response.headers['ETag']
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+    train(client, maze_id, passes=0, planning_steps=5)
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.json['hp']['planning_steps'] == 5
+    client.delete(f'/maze/{maze_id}')
@@ -0,0 +1,149 @@
+import numpy as np
+import pytest
+from maze import Maze, MazeCell
+
+def new_maze(rows = 12, cols = 15, seed = 1):
+    maze = Maze({'rows': rows, 'cols': cols})
+    maze.make_maze(seed=seed)
+    return maze
+
+def test_maze_is_spanning_tree():
+    maze = new_maze()
+    cells = maze.rows * maze.cols
+    # every passage is counted from both of its cells
+    passages = sum(bin(int(bits)).count('1') for bits in maze.legal.reshape(-1)) // 2
+    assert passages == cells - 1
+    assert (maze.goal_distances() >= 0).all()
+
+def test_legal_moves_match_both_ways():
+    maze = new_maze()
+    for y in range(maze.rows):
+        for x in range(maze.cols):
+            for i, (dx, dy) in enumerate(MazeCell.moves):
+                if maze.legal[y, x] & MazeCell.move_bits[i]:
+                    assert 0 <= x + dx < maze.cols and 0 <= y + dy < maze.rows
+                    assert maze.legal[y + dy, x + dx] & MazeCell.move_bits[(i + 2) % 4]
+
+def test_dict_for_json_shape():
+    maze = new_maze(4, 5)
+    result = maze.dict_for_json()
+    assert {'rows', 'cols', 'cell_matrix', 'paths', 'total_training_passes',
+            'generated', 'solve_path'} <= set(result)
+    assert len(result['cell_matrix']) == 4 and len(result['cell_matrix'][0]) == 5
+    cell = result['cell_matrix'][2][3]
+    assert (cell['x'], cell['y']) == (3, 2)
+    assert {'x', 'y', 'hp', 'legal', 'q', 'goal'} <= set(cell)
+    assert set(cell['legal']) == set(cell['q']) == {'s', 'e', 'n', 'w'}
+    assert {'epsilon', 'alpha', 'gamma', 'rIllegal', 'rLegal', 'rGoal'} <= set(cell['hp'])
+    assert result['cell_matrix'][3][4]['goal'] and not cell['goal']
+    assert {tuple(loc) for path in result['paths'] for loc in path} == {(x, y) for x in range(5) for y in range(4)}
+
+def test_seeded_generation_and_training_are_reproducible():
+    first = new_maze(seed=7)
+    second = new_maze(seed=7)
+    assert np.array_equal(first.legal, second.legal)
+    assert not np.array_equal(first.legal, new_maze(seed=8).legal)
+    for batch_size in (1, 8):
+        first.make_maze(seed=7)
+        second.make_maze(seed=7)
+        first.rl_train(40, batch_size, seed=3, max_episode_steps=500)
+        second.rl_train(40, batch_size, seed=3, max_episode_steps=500)
+        assert np.array_equal(first.q, second.q)
+
+def test_solving_between_chunks_leaves_seeded_training_unchanged():
+    def train(solve):
+        maze = new_maze(20, 20)
+        maze.rl_train(100, 1, 3, 1000, 500)
+        if solve:
+            maze.solve_from(0, 0, 100) # q values are all 0 in most cells, so moves are random
+        maze.rl_train(100, 1, None, 1000, 2000, maze.unfinished)
+        return maze.q
+    assert np.array_equal(train(False), train(True))
+
+def test_solve_from_reaches_goal_after_training():
+    maze = new_maze(8, 8)
+    maze.rl_train(3000, seed=2)
+    maze.solve_from(0, 0, 1000)
+    assert maze.solve_path[0] == (0, 0)
+    assert maze.solve_path[-1] == maze.loc(maze.goal_state)
+    assert len(maze.solve_path) - 1 == maze.goal_distances()[0]
+
+def test_batch_training_runs_passes_episodes():
+    maze = new_maze(20, 20)
+    for passes in (0, 5, 64, 65, 500):
+        steps = maze.rl_train(passes, 64, seed=2, max_episode_steps=300)
+        assert len(maze.episode_lengths) == passes
+        assert maze.episode_lengths.sum() == steps
+
+@pytest.mark.parametrize('batch_size', [1, 16])
+def test_training_resumes_unfinished_episodes(batch_size):
+    def train(max_steps):
+        maze = new_maze(20, 20)
+        passes, seed, episodes, lengths, steps = 100, 3, None, [], 0
+        while passes:
+            steps += maze.rl_train(passes, batch_size, seed, 1000, max_steps, episodes)
+            seed, episodes = None, maze.unfinished
+            passes -= len(maze.episode_lengths)
+            lengths.append(maze.episode_lengths)
+        return maze, steps, np.concatenate(lengths)
+    whole, steps, lengths = train(None)
+    chunked, chunked_steps, chunked_lengths = train(333)
+    assert np.array_equal(whole.q, chunked.q)
+    assert steps == chunked_steps == lengths.sum()
+    assert np.array_equal(lengths, chunked_lengths)
+    assert whole.total_training_passes == chunked.total_training_passes == 100
+
+def test_solve_cache_follows_version(monkeypatch):
+    maze = new_maze(10, 10)
+    maze.rl_train(500, seed=2)
+    maze.solve_from(0, 0, 100)
+    path = maze.solve_path
+    maze.solve_from(0, 0, 100)
+    assert maze.solve_path is path
+    assert maze.policy is None # solving doesn't build the policy map
+    maze.changed()
+    maze.solve_from(0, 0, 100)
+    assert maze.solve_path is not path and maze.solve_path == path
+
+    # least recently used solutions are dropped beyond the cache size
+    import maze as maze_module
+    monkeypatch.setattr(maze_module, 'SOLVE_CACHE_BYTES', 3000)
+    for x in range(10):
+        maze.solve_batch([(x, 0)], 5)
+    assert maze.solve_cache_bytes <= 3000
+    assert ('solve_batch', 9, 0, 5) in maze.solve_cache
+    assert ('solve_batch', 0, 0, 5) not in maze.solve_cache
+
+@pytest.mark.parametrize('sweeping', [False, True])
+def test_planning_converges_in_fewer_steps(sweeping):
+    def steps_to_converge(planning_steps):
+        maze = new_maze(20, 20)
+        maze.hp.planning_steps = planning_steps
+        maze.hp.prioritized_sweeping = sweeping
+        steps, seed = 0, 2
+        while maze.convergence()['converged'] < 0.95:
+            steps += maze.rl_train(1 << 30, 1, seed, 500, 1000, maze.unfinished)
+            seed = None
+        return steps, maze
+    planned, maze = steps_to_converge(10)
+    assert planned < steps_to_converge(0)[0] / 2
+    # only moves in the model are backed up
+    for i, bit in enumerate(MazeCell.move_bits):
+        assert (maze.q[..., i][(maze.observed & bit) == 0] == 0).all()
+
+@pytest.mark.parametrize('batch_size, planning_steps', [(1, 0), (1, 5), (8, 0)])
+def test_training_without_steps_keeps_version(batch_size, planning_steps):
+    maze = new_maze(5, 5)
+    maze.hp.planning_steps = planning_steps
+    policy = maze.policy_map()
+    version = maze.version
+    maze.rl_train(0, batch_size, seed=1)
+    assert maze.version == version and maze.policy_map() is policy
+    maze.rl_train(3, batch_size, seed=1)
+    assert maze.version == version + 1 == maze.q_version.max()
+
+    # every pass in a 1x1 maze starts at the goal
+    maze = new_maze(1, 1)
+    maze.hp.planning_steps = planning_steps
+    maze.rl_train(3, batch_size, seed=1)
+    assert maze.version == maze.q_version.max() == 1
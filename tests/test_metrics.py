@@ -0,0 +1,83 @@
+import math
+import re
+import time
+import numpy as np
+import pytest
+from metrics import MetricsRegistry, format_value
+from app import app
+
+def parse(text):
+    "samples of the text format as {(name, ((label, value), ...)): value}"
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        match = re.fullmatch(r'(\w+)(?:\{(.*)\})? (\S+)', line)
+        assert match, line
+        name, labels, value = match.groups()
+        labels = tuple(sorted(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', labels or '')))
+        samples[(name, labels)] = float(value)
+    return samples
+
+def test_text_format():
+    registry = MetricsRegistry()
+    counter = registry.counter('requests_total', 'Requests.', ('method',))
+    gauge = registry.gauge('size_bytes', 'Size.', function=lambda: 1.5)
+    counter.inc(method='GET')
+    counter.inc(2, method='GET')
+    counter.inc(method='PO"ST')
+    text = registry.expose()
+    assert '# HELP requests_total Requests.\n# TYPE requests_total counter\n' in text
+    assert '# TYPE size_bytes gauge\nsize_bytes 1.5\n' in text
+    samples = parse(text)
+    assert samples[('requests_total', (('method', 'GET'),))] == 3
+    assert samples[('requests_total', (('method', 'PO\\"ST'),))] == 1
+    with pytest.raises(ValueError):
+        counter.inc(endpoint='/')
+    with pytest.raises(ValueError):
+        registry.counter('requests_total', 'Again.')
+    assert format_value(math.inf) == '+Inf' and format_value(2.0) == '2'
+
+def test_histogram_buckets_include_their_bound():
+    registry = MetricsRegistry()
+    one = registry.histogram('one', 'One at a time.', buckets=(1, 2, 5))
+    many = registry.histogram('many', 'All at once.', buckets=(1, 2, 5))
+    values = [0.5, 1, 1.5, 2, 5, 7]
+    for value in values:
+        one.observe(value)
+    many.observe_many(np.array(values))
+    samples = parse(registry.expose())
+    for name in ('one', 'many'):
+        buckets = [samples[(name + '_bucket', (('le', bound),))] for bound in ('1', '2', '5', '+Inf')]
+        assert buckets == [2, 4, 5, 6] # le is inclusive and cumulative
+        assert samples[(name + '_count', ())] == 6 and samples[(name + '_sum', ())] == sum(values)
+
+def test_metrics_endpoint():
+    client = app.test_client()
+    before = parse(client.get('/metrics').get_data(as_text=True))
+    maze_id = client.post('/create', json={'rows': 10, 'cols': 10, 'seed': 1}).json['id']
+    client.get(f'/maze/{maze_id}?format=compact')
+    client.get('/maze/missing')
+    job = client.post(f'/train/{maze_id}', json={'passes': 20, 'seed': 1}).json
+    while job['state'] in ('queued', 'running'):
+        time.sleep(0.01)
+        job = client.get(f'/jobs/{job["id"]}').json
+    response = client.get('/metrics')
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    after = parse(response.get_data(as_text=True))
+
+    def change(name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        return after.get(key, 0) - before.get(key, 0)
+    assert change('http_requests_total', method='POST', endpoint='/create', status='201') == 1
+    assert change('http_requests_total', method='GET', endpoint='/maze/<maze_id>', status='404') == 1
+    assert change('http_request_duration_seconds_count', method='GET', endpoint='/maze/<maze_id>') == 2
+    assert change('maze_serialization_seconds_count', format='compact') == 1
+    assert change('maze_training_passes_total') == 20
+    assert change('maze_training_steps_total') == job['steps']
+    assert change('maze_training_episode_length_steps_count') == 20
+    assert change('maze_training_episode_length_steps_sum') == job['steps']
+    assert change('maze_training_jobs_total', state='done') == 1
+    import app as server
+    assert after[('maze_memory_bytes', ())] == server.mazes.total_size > 0
+    client.delete(f'/maze/{maze_id}')
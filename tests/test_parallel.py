@@ -0,0 +1,31 @@
+import threading
+import numpy as np
+import pytest
+from maze import Maze
+from parallel import ParallelTrainer
+
+def train(seed, lock = None, planning_steps = 0):
+    maze = Maze({'rows': 15, 'cols': 15})
+    maze.make_maze(seed=1)
+    maze.hp.planning_steps = planning_steps
+    with ParallelTrainer(maze, 2, 50, seed) as trainer:
+        steps = trainer.train(200, 1, 500, lock)
+    return maze, steps
+
+def test_seeded_parallel_training_is_reproducible():
+    first, steps = train(4, threading.RLock())
+    second, _ = train(4)
+    assert np.array_equal(first.q, second.q)
+    assert len(first.episode_lengths) == first.total_training_passes == 200
+    assert first.episode_lengths.sum() == steps
+
+def test_seeded_parallel_planning_is_reproducible():
+    first, _ = train(4, planning_steps=5)
+    second, _ = train(4, planning_steps=5)
+    assert np.array_equal(first.q, second.q)
+    # the moves observed by the workers are merged into the maze
+    assert np.array_equal(first.observed, second.observed) and first.observed.any()
+
+def test_sync_passes_at_least_one():
+    with pytest.raises(ValueError):
+        ParallelTrainer(Maze({'rows': 2, 'cols': 2}), 2, 0)
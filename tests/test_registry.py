@@ -0,0 +1,53 @@
+import pytest
+from maze import Maze
+from registry import MazeRegistry, OverBudget
+
+def new_maze(size = 10):
+    maze = Maze({'rows': size, 'cols': size})
+    maze.make_maze(seed=1)
+    return maze
+
+def test_least_recently_used_evicted():
+    size = new_maze().nbytes()
+    mazes = MazeRegistry(3 * size)
+    first, second, third = (mazes.add(new_maze()) for _ in range(3))
+    mazes.get(first.id)
+    mazes.add(new_maze())
+    assert mazes.get(second.id) is None
+    assert mazes.get(first.id) is first and mazes.get(third.id) is third
+    assert mazes.total_size == sum(entry.size for entry in mazes.all())
+
+def test_maze_over_budget_refused():
+    mazes = MazeRegistry(new_maze().nbytes() * 2)
+    kept = mazes.add(new_maze())
+    with pytest.raises(OverBudget):
+        mazes.add(new_maze(30))
+    assert mazes.get(kept.id) is kept
+    assert Maze.estimated_nbytes(30, 30) >= new_maze(30).nbytes()
+
+def test_resize_counts_cached_results():
+    mazes = MazeRegistry()
+    entry = mazes.add(new_maze(20))
+    before = entry.size
+    entry.maze.rl_train(50, seed=1)
+    entry.maze.convergence()
+    mazes.resize(entry)
+    assert before < entry.size <= Maze.estimated_nbytes(20, 20)
+    before = entry.size
+    entry.maze.solve_from(0, 0, 100)
+    mazes.resize(entry)
+    assert entry.size > before
+    assert mazes.total_size == entry.size
+
+def test_pinned_maze_not_evicted():
+    size = new_maze().nbytes()
+    mazes = MazeRegistry(2 * size)
+    pinned = mazes.add(new_maze())
+    assert mazes.pin(pinned.id) is pinned
+    mazes.add(new_maze())
+    mazes.add(new_maze())
+    assert mazes.holds(pinned)
+    mazes.unpin(pinned)
+    mazes.add(new_maze())
+    assert not mazes.holds(pinned)
+    assert mazes.pin(pinned.id) is None
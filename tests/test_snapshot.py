@@ -0,0 +1,50 @@
+import os
+import time
+from maze import Maze
+from registry import MazeRegistry
+from snapshot import Checkpointer
+
+def new_maze(size = 10):
+    maze = Maze({'rows': size, 'cols': size})
+    maze.make_maze(seed=1)
+    return maze
+
+def test_snapshots_pruned_to_disk_budget(tmp_path):
+    registry = MazeRegistry()
+    checkpoints = Checkpointer(registry, str(tmp_path), 0)
+    entries = [registry.add(new_maze()) for _ in range(4)]
+    for entry in entries:
+        checkpoints.save(entry)
+    size = checkpoints.snapshots()[0]['size']
+    for entry in entries[:3]:
+        registry.remove(entry.id)
+        entry.removed = False # as if evicted rather than deleted
+    checkpoints.disk_budget = 2 * size
+    checkpoints.save(entries[1])
+    # the oldest snapshots of mazes not in memory go first, the one just written stays
+    assert {snapshot['id'] for snapshot in checkpoints.snapshots()} == {entries[1].id, entries[3].id}
+
+def test_deleted_maze_not_saved(tmp_path):
+    registry = MazeRegistry()
+    checkpoints = Checkpointer(registry, str(tmp_path), 0)
+    entry = registry.add(new_maze())
+    registry.remove(entry.id)
+    checkpoints.remove(entry.id)
+    assert checkpoints.save(entry) is None
+    assert not os.path.exists(checkpoints.path(entry.id))
+    assert checkpoints.get(entry.id) is None
+
+def test_checkpoints_carry_on_after_errors(tmp_path):
+    registry = MazeRegistry()
+    checkpoints = Checkpointer(registry, str(tmp_path), 0.01)
+    entry = registry.add(new_maze())
+    calls = []
+
+    def save(entry):
+        calls.append(entry.id)
+        raise ValueError('failed')
+    checkpoints.save = save
+    checkpoints.start()
+    time.sleep(0.2)
+    assert len(calls) > 1 and checkpoints.thread.is_alive()
+    registry.remove(entry.id) # nothing left for the thread to save